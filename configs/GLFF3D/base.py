@@ -14,6 +14,8 @@ optimizer = dict(
 
 model = dict(
     type='TwoStageSparse3DDetector',
+    # 'SparseDeformableDetrEncoder' with sparse=True and e.g. radius=2 only
+    # encodes the image tokens around the projected stage-2 proposals
     img_encoder=dict(
         type='DeformableDetrEncoder',
         encoder=dict(
@@ -64,6 +66,8 @@ model = dict(
         decoder=dict(
             type='TransformerDecoderLayerWithPos',
             num_layers=1,
+            # [BS, N, C] queries and values, no layout permutes in the head
+            batch_first=True,
             transformerlayers=dict(
                 type='DetrTransformerDecoderLayer',
                 attn_cfgs=[
@@ -72,6 +76,9 @@ model = dict(
                         embed_dims=256,
                         num_heads=8,
                         dropout=0.1),
+                    # 'LazyValueDeformableAttention' samples the raw
+                    # image features and projects the samples only,
+                    # 'CPUDeformableAttention' is faster on CPU deployments
                     dict(
                         type='MultiScaleDeformableAttention',
                         embed_dims=256)
@@ -88,6 +95,9 @@ model = dict(
         ),
     ),
     freeze_img_branch=True,
+    # optionally cache the frozen image features on disk across epochs, e.g.
+    # img_feat_cache=dict(cache_dir='data/sunrgbd/img_feat_cache',
+    #                     max_bytes=64 * 1024**3),
     test_cfg=dict(
         ensemble_stages=[2]
     ),
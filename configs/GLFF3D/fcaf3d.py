@@ -28,6 +28,9 @@ model = dict(
         nms_pre=1000,
         iou_thr=.5,
         score_thr=.01,
+        # 'gpu' (pcdet kernels), 'cpu', 'bucketed' (grid bucketed pairs, for
+        # large candidate sets) or 'auto' (gpu for cuda tensors)
+        nms_backend='auto',
         ensemble_stages=[0,1]))
 
 find_unused_parameters = True
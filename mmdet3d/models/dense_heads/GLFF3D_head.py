@@ -1,20 +1,94 @@
+from collections import OrderedDict
+
 import torch
 from torch import nn
 import torch.nn.functional as F
 import MinkowskiEngine as ME
 from mmcv.cnn import constant_init
 from mmcv.cnn.bricks.transformer import build_transformer_layer
-from mmdet.core import reduce_mean, build_assigner
+from mmdet.core import build_assigner
 from mmdet.models.builder import HEADS, build_loss
 from mmcv.cnn import Scale, bias_init_with_prob
 
-from mmdet3d.ops.pcdet_nms import pcdet_nms_gpu, pcdet_nms_normal_gpu
 from mmdet3d.models import builder
-from mmdet3d.core.bbox import points_cam2img
+from mmdet3d.models.utils.bev_nms import batched_nms_3d
+from mmdet3d.models.utils.deferred_norm import DeferredNormalizer
 from mmdet3d.models.fusion_layers import (apply_3d_transformation,
                                           coord_2d_transform)
 
 
+def get_key_padding_mask(valid_mask):
+    """Key padding mask of the attention between the proposals.
+
+    The first slot of a scene is only invalid when the scene has no
+    proposal at all. It stays unmasked, as attending to no key gives NaNs.
+    """
+    if valid_mask is None:
+        return None
+    key_padding_mask = ~valid_mask
+    key_padding_mask[:, 0] = False
+    return key_padding_mask
+
+
+def batched_loss(head, centerness, bbox_preds, cls_scores, points,
+                 centerness_targets, bbox_targets, labels, batch_ids,
+                 batch_size, normalizer, prefix='', cls_weight=None):
+    """Centerness, bbox and cls losses of all scenes in one call each.
+
+    Rows of all scenes are flattened together, the losses summed per scene
+    and added to ``normalizer`` with the per scene normalizers, so the
+    final losses equal the mean over scenes of the per scene losses.
+
+    Args:
+        head (nn.Module): Head with the loss modules and _bbox_pred_to_bbox.
+        batch_ids (torch.Tensor): Scene of every row with shape (N,).
+        batch_size (int): Number of scenes.
+        normalizer (DeferredNormalizer): Collects the losses.
+        prefix (str, optional): Prefix of the loss names. Defaults to ''.
+        cls_weight (torch.Tensor, optional): Weight of every row in the cls
+            loss with shape (N,).
+    """
+    # skip background
+    pos_inds = torch.nonzero(labels >= 0).squeeze(1)
+    pos_batch_ids = batch_ids[pos_inds]
+    n_pos = normalizer.register(
+        torch.bincount(pos_batch_ids, minlength=batch_size), 1.)
+    loss_cls = head.loss_cls(
+        cls_scores, labels, weight=cls_weight, reduction_override='none')
+    loss_cls = loss_cls.new_zeros(batch_size).index_add(
+        0, batch_ids, loss_cls.sum(dim=1))
+    pos_centerness = centerness[pos_inds]
+    pos_bbox_preds = bbox_preds[pos_inds]
+    pos_centerness_targets = centerness_targets[pos_inds].unsqueeze(1)
+    pos_bbox_targets = bbox_targets[pos_inds]
+    # centerness weighted iou loss
+    centerness_denorm = normalizer.register(
+        pos_centerness_targets.new_zeros(batch_size).index_add(
+            0, pos_batch_ids, pos_centerness_targets.squeeze(1)), 1e-6)
+    if len(pos_inds) > 0:
+        pos_points = points[pos_inds]
+        loss_centerness = head.loss_centerness(
+            pos_centerness, pos_centerness_targets,
+            reduction_override='none').squeeze(1)
+        loss_bbox = head.loss_bbox(
+            head._bbox_pred_to_bbox(pos_points, pos_bbox_preds),
+            pos_bbox_targets,
+            weight=pos_centerness_targets.squeeze(1),
+            reduction_override='none')
+    else:
+        loss_centerness = pos_centerness.sum(dim=1)
+        loss_bbox = pos_bbox_preds.sum(dim=1)
+    normalizer.add(prefix + 'loss_cls', loss_cls, n_pos)
+    normalizer.add(
+        prefix + 'loss_centerness',
+        loss_centerness.new_zeros(batch_size).index_add(
+            0, pos_batch_ids, loss_centerness), n_pos)
+    normalizer.add(
+        prefix + 'loss_bbox',
+        loss_bbox.new_zeros(batch_size).index_add(
+            0, pos_batch_ids, loss_bbox), centerness_denorm)
+
+
 @HEADS.register_module()
 class CAHead(nn.Module):
     def __init__(self, 
@@ -47,7 +121,7 @@ class CAHead(nn.Module):
         self.yaw_parametrization = yaw_parametrization
 
     def forward(self, select_points, img_dict=None):
-        points, features, sort_inds = select_points
+        points, features = select_points[:2]
         if img_dict and self.fusion_layer:
             img_features, img_metas = img_dict['img_features'], img_dict['img_metas']
             # fusion layer, fused_features stage*batch*C*N
@@ -68,70 +142,57 @@ class CAHead(nn.Module):
         
         return centerness, bbox_pred, cls_scores
 
-    def loss(self, stage_preds, targets, points):
-        loss_centerness, loss_bbox, loss_cls = [], [], []
-        batch_size = points.shape[0]
-        for i in range(batch_size):
-            img_loss_centerness, img_loss_bbox, img_loss_cls = self._loss_single(
-                centerness=stage_preds[0][i],
-                bbox_preds=stage_preds[1][i],
-                cls_scores=stage_preds[2][i],
-                points=points[i],
-                centerness_targets=targets[0][i],
-                bbox_targets=targets[1][i],
-                labels=targets[2][i],
-            )
-            loss_centerness.append(img_loss_centerness)
-            loss_bbox.append(img_loss_bbox)
-            loss_cls.append(img_loss_cls)
-        return dict(
-            stage2_loss_centerness=torch.mean(torch.stack(loss_centerness)),
-            stage2_loss_bbox=torch.mean(torch.stack(loss_bbox)),
-            stage2_loss_cls=torch.mean(torch.stack(loss_cls))
-        )
-
-    def _loss_single(self, centerness, bbox_preds, cls_scores, points,
-                    centerness_targets, bbox_targets, labels):
-        
-        # skip background
-        pos_inds = torch.nonzero(labels >= 0).squeeze(1)
-        n_pos = torch.tensor(len(pos_inds), dtype=torch.float, device=centerness.device)
-        n_pos = max(reduce_mean(n_pos), 1.)
-        loss_cls = self.loss_cls(cls_scores, labels, avg_factor=n_pos)
-        pos_centerness = centerness[pos_inds]
-        pos_bbox_preds = bbox_preds[pos_inds]
-        pos_centerness_targets = centerness_targets[pos_inds].unsqueeze(1)
-        pos_bbox_targets = bbox_targets[pos_inds]
-        # centerness weighted iou loss
-        centerness_denorm = max(
-            reduce_mean(pos_centerness_targets.sum().detach()), 1e-6)
-        if len(pos_inds) > 0:
-            pos_points = points[pos_inds]
-            loss_centerness = self.loss_centerness(
-                pos_centerness, pos_centerness_targets, avg_factor=n_pos
-            )
-            loss_bbox = self.loss_bbox(
-                self._bbox_pred_to_bbox(pos_points, pos_bbox_preds),
-                pos_bbox_targets,
-                weight=pos_centerness_targets.squeeze(1),
-                avg_factor=centerness_denorm
-            )
-        else:
-            # loss_centerness = centerness.sum() * 0.0
-            # loss_bbox = bbox_preds.sum() * 0.0
-            loss_centerness = pos_centerness.sum()
-            loss_bbox = pos_bbox_preds.sum()
-        return loss_centerness, loss_bbox, loss_cls
+    def loss(self, stage_preds, targets, points, valid_mask=None,
+             normalizer=None):
+        return self._loss(stage_preds, targets, points, valid_mask, normalizer)
+
+    def _loss(self, stage_preds, targets, points, valid_mask=None,
+              normalizer=None):
+        """Stage-2 losses of all scenes.
+
+        With a ``normalizer`` the losses are only added to it and an empty
+        dict is returned, see DeferredNormalizer.
+        """
+        batch_size, n_proposals = points.shape[:2]
+        labels = targets[2].reshape(-1)
+        # padded proposals are neither positives nor negatives
+        cls_weight = None
+        if valid_mask is not None:
+            valid_mask = valid_mask.reshape(-1)
+            labels = torch.where(valid_mask, labels, labels.new_tensor(-1))
+            cls_weight = valid_mask.float()
+        batch_ids = torch.arange(
+            batch_size, device=points.device).repeat_interleave(n_proposals)
+        deferred = normalizer is not None
+        if not deferred:
+            normalizer = DeferredNormalizer()
+        batched_loss(
+            self,
+            centerness=stage_preds[0].reshape(batch_size * n_proposals, -1),
+            bbox_preds=stage_preds[1].reshape(batch_size * n_proposals, -1),
+            cls_scores=stage_preds[2].reshape(batch_size * n_proposals, -1),
+            points=points.reshape(batch_size * n_proposals, -1),
+            centerness_targets=targets[0].reshape(-1),
+            bbox_targets=targets[1].reshape(batch_size * n_proposals, -1),
+            labels=labels,
+            batch_ids=batch_ids,
+            batch_size=batch_size,
+            normalizer=normalizer,
+            prefix='stage2_',
+            cls_weight=cls_weight)
+        return dict() if deferred else normalizer.compute()
 
     def get_bboxes(self, stage_preds, points, img_metas,
-                   rescale=False):
+                   rescale=False, valid_mask=None):
         results = []
         for i in range(len(img_metas)):
+            # drop the padded proposals
+            keep = slice(None) if valid_mask is None else valid_mask[i]
             result = self._get_bboxes_single(
-                centernesses=stage_preds[0][i],
-                bbox_preds=stage_preds[1][i],
-                cls_scores=stage_preds[2][i],
-                points=points[i],
+                centernesses=stage_preds[0][i][keep],
+                bbox_preds=stage_preds[1][i][keep],
+                cls_scores=stage_preds[2][i][keep],
+                points=points[i][keep],
                 img_meta=img_metas[i]
             )
             results.append(result)
@@ -236,24 +297,36 @@ class CAHeadIter(CAHead):
         self.loss_bbox = build_loss(loss_bbox)
         self.loss_cls = build_loss(loss_cls)
         self.yaw_parametrization = yaw_parametrization
+        # decoder inputs that only depend on the image shapes
+        self.geometry_cache = OrderedDict()
 
-    def forward(self, select_points, img_dict):
-        points, features, _ = select_points
-        # [B, C, N]
-        features = self.upsample_layer(features.permute(0, 2, 1))
+    def forward(self, select_points, img_dict, pred_layers=None):
+        points, features, _, valid_mask = select_points
+        # [B, N, C]
+        features = self.pointwise(self.upsample_layer, features)
         img_features, img_metas = img_dict['img_features'], img_dict['img_metas']
 
         preds_all = self.transformer_decoder(
-            features, points, img_features, img_metas
+            features, points, img_features, img_metas, pred_layers=pred_layers,
+            valid_mask=valid_mask
         )
         return preds_all
 
+    @property
+    def batch_first(self):
+        """Whether the decoder layers take [BS, N, C] queries and values."""
+        return getattr(self.decoder[0], 'batch_first', False)
+
+    @staticmethod
+    def pointwise(conv, x):
+        """Apply a kernel size 1 Conv1d to [B, N, C] features."""
+        return F.linear(x, conv.weight.squeeze(-1), conv.bias)
+
     def split_pred(self, preds, base_xyz):
+        # preds [B, N, C]
         results = {}
         start, end = 0, 0
 
-        preds = preds.transpose(2, 1)
-
         # decode centerness
         end += 1
         # (batch_size, 1, num_proposal)
@@ -280,46 +353,95 @@ class CAHeadIter(CAHead):
 
         return results
 
+    def predict(self, i, query, points, full=True):
+        """Run the i-th prediction head on [B, N, C] query features.
+
+        With ``full=False`` only the box distances that the next decoder
+        layer needs for its query position embedding are computed.
+        """
+        if full:
+            return self.split_pred(
+                self.pointwise(self.conv_preds[i], query), points)
+        conv_pred = self.conv_preds[i]
+        distance = F.linear(
+            query, conv_pred.weight[1:7, :, 0], conv_pred.bias[1:7])
+        return dict(distance=torch.exp(distance), ref_points=points)
+
+    def decoder_extra_inputs(self, img_features, reference_points,
+                             valid_ratios):
+        """Extra keyword inputs of the decoder layers."""
+        return dict()
+
     def transformer_decoder(self, 
                             features,
                             points,
                             img_features,
                             img_metas,
+                            pred_layers=None,
+                            valid_mask=None,
                             ):
-        decode_res_all = []
+        """Refine the proposals with the decoder layers.
+
+        Args:
+            pred_layers (list[int], optional): Predictions to return, 0 is
+                the proposal prediction and i the output of the i-th
+                decoder layer. The others are left as None and decoder
+                layers after the last requested one are skipped.
+                Defaults to all predictions.
+            valid_mask (torch.Tensor, optional): Which proposals are real
+                with shape (B, N). Padded ones are masked out of the self
+                attention.
+        """
+        if pred_layers is None:
+            pred_layers = range(self.num_decoder_layers + 1)
+        last_layer = max(pred_layers, default=-1)
+        decode_res_all = [None] * (self.num_decoder_layers + 1)
+        if last_layer < 0:
+            return decode_res_all
 
         # get proposals
-        predictions = self.conv_preds[0](features)
-        decode_res = self.split_pred(predictions, points)
-        decode_res_all.append(decode_res)
+        decode_res = self.predict(0, features, points, 0 in pred_layers)
+        decode_res_all[0] = decode_res
+        if last_layer == 0:
+            return decode_res_all
 
         # get inputs
         feat_flatten, mask_flatten, reference_points, spatial_shapes,\
             level_start_index, valid_ratios = self.prepare_decoder_inputs(
                 points, img_features, img_metas)
+        extra_inputs = self.decoder_extra_inputs(
+            img_features, reference_points, valid_ratios)
 
-        query = features.permute(2, 0, 1)
-        for i in range(self.num_decoder_layers):
+        query_key_padding_mask = get_key_padding_mask(valid_mask)
+        # a view, [BS, N_query, C] or [N_query, BS, C]
+        query = features if self.batch_first else features.transpose(0, 1)
+        for i in range(last_layer):
             query_pos = torch.cat(
                 [decode_res['distance'], decode_res['ref_points']], 
                 dim=-1).detach().clone()
             query = self.decoder[i](
-                query=query,  # [N_query, BS, C_query]
+                query=query,
                 key=None,
-                value=feat_flatten,  # [N_value, BS, C_value]
+                value=feat_flatten,
                 query_pos=query_pos,  # [N_query, BS, C_query]
                 key_padding_mask=mask_flatten,  # [BS, N_value]
+                query_key_padding_mask=query_key_padding_mask,  # [BS, N_query]
                 reference_points=reference_points,  # [BS, N_query, 2]
                 spatial_shapes=spatial_shapes,  # [N_lvl, 2]
                 level_start_index=level_start_index,  # [N_lvl]
                 valid_ratios=valid_ratios,  # [BS, N_lvl, 2]
+                **extra_inputs,
             )
 
-            predictions = self.conv_preds[i+1](query.permute(1, 2, 0))
-            decode_res = self.split_pred(predictions, points)
-            decode_res_all.append(decode_res)            
+            decode_res = self.predict(
+                i + 1, query if self.batch_first else query.transpose(0, 1),
+                points, i + 1 in pred_layers)
+            decode_res_all[i + 1] = decode_res
 
-        return decode_res_all
+        return [
+            res if i in pred_layers else None
+            for i, res in enumerate(decode_res_all)
+        ]
 
     def get_valid_ratio(self, mask):
         """Get the valid radios of feature maps of all  level."""
@@ -331,38 +453,73 @@ class CAHeadIter(CAHead):
         valid_ratio = torch.stack([valid_ratio_w, valid_ratio_h], -1)
         return valid_ratio
 
+    @staticmethod
+    def get_img_projection(img_meta, device):
+        """3x4 matrix from augmented 3D points to normalized image coords.
+
+        The reverse 3D augmentation, the depth2img projection, the 2D
+        image transformation and the normalization by the image size are
+        composed into one matrix, cached on the meta. Both augmentations are
+        affine, so they are recovered from the images of a few basis points
+        by apply_3d_transformation and coord_2d_transform.
+        """
+        projection = img_meta.get('_img_projection')
+        if projection is not None and projection.device == device:
+            return projection
+        # the images of the origin and of the unit vectors are t and the
+        # rows of A + t, with p @ A + t the transformation of a row vector p
+        basis = torch.cat((torch.zeros(1, 3), torch.eye(3))).double()
+        images = apply_3d_transformation(
+            basis, 'DEPTH', img_meta, reverse=True)
+        transform_3d = torch.eye(4, dtype=torch.double)
+        transform_3d[:3, :3] = (images[1:] - images[:1]).T
+        transform_3d[:3, 3] = images[0]
+        depth2img = torch.eye(4, dtype=torch.double)
+        proj = torch.as_tensor(img_meta['depth2img'], dtype=torch.double)
+        depth2img[:proj.shape[0], :proj.shape[1]] = proj
+        basis = torch.tensor([[0., 0.], [1., 0.], [0., 1.]]).double()
+        images = coord_2d_transform(img_meta, basis, True)
+        transform_2d = torch.eye(3, dtype=torch.double)
+        transform_2d[:2, :2] = (images[1:] - images[:1]).T
+        transform_2d[:2, 2] = images[0]
+        img_shape = img_meta['img_shape']
+        normalize = torch.diag(torch.tensor(
+            [1. / (img_shape[1] - 1), 1. / (img_shape[0] - 1), 1.]).double())
+        projection = (normalize @ transform_2d @ depth2img[:3]
+                      @ transform_3d).float().to(device)
+        img_meta['_img_projection'] = projection
+        return projection
+
+    def project_to_img(self, seeds_3d_batch, img_metas):
+        """Normalized image coordinates of [B, N, 3] points, in one bmm."""
+        projection = torch.stack([
+            self.get_img_projection(img_meta, seeds_3d_batch.device)
+            for img_meta in img_metas
+        ])
+        uvw = torch.baddbmm(projection[:, None, :, 3], seeds_3d_batch,
+                            projection[:, :, :3].transpose(1, 2))
+        uv = uvw[..., :2] / uvw[..., 2:3]
+        return torch.clamp(uv, 0, 1)
+
     def get_reference_points(self, seeds_3d_batch, img_metas):
-        uv_all = []
-        for seeds_3d, img_meta in zip(seeds_3d_batch, img_metas):
-            img_shape = img_meta['img_shape']
-            
-            # first reverse the data transformations
-            xyz_depth = apply_3d_transformation(
-                seeds_3d, 'DEPTH', img_meta, reverse=True)
-            
-            # project points from depth to image
-            depth2img = xyz_depth.new_tensor(img_meta['depth2img'])
-            uv_origin = points_cam2img(xyz_depth, depth2img, False)
-            # uv_origin = uv_origin - 1
-            # uv_origin = (uv_origin - 1).round()
-            
-            # transform and normalize 2d coordinates
-            uv_transformed = coord_2d_transform(img_meta, uv_origin, True)
-            uv_transformed[:, 0] = uv_transformed[:, 0] / (img_shape[1] - 1)
-            uv_transformed[:, 1] = uv_transformed[:, 1] / (img_shape[0] - 1)
-            uv_transformed = torch.clamp(uv_transformed, 0, 1)
-            
-            uv_all.append(uv_transformed)
-        uv_all = torch.stack(uv_all, dim=0)
-        return uv_all
+        return self.project_to_img(seeds_3d_batch, img_metas)
+
+    def get_decoder_geometry(self, mlvl_feats, img_metas):
+        """Flattened padding masks, spatial shapes, level start indices and
+        valid ratios of the multi-level image features.
+
+        They only depend on the image and feature shapes, which rarely
+        change between batches, so they are cached by these shapes.
+        """
+        key = (tuple(img_metas[0]['batch_input_shape']),
+               tuple(tuple(img_meta['img_shape']) for img_meta in img_metas),
+               tuple(tuple(feat.shape[-2:]) for feat in mlvl_feats),
+               mlvl_feats[0].device)
+        geometry = self.geometry_cache.get(key)
+        if geometry is not None:
+            self.geometry_cache.move_to_end(key)
+            return geometry
 
-    def prepare_decoder_inputs(self, 
-                               seeds_3d,
-                               mlvl_feats,
-                               img_metas,):
-        # get_reference_points
-        reference_points = self.get_reference_points(seeds_3d, img_metas)
-        
         # get masks
         batch_size = mlvl_feats[0].size(0)
         input_img_h, input_img_w = img_metas[0]['batch_input_shape']
@@ -376,83 +533,89 @@ class CAHeadIter(CAHead):
             mlvl_masks.append(
                 F.interpolate(img_masks[None],
                               size=feat.shape[-2:]).to(torch.bool).squeeze(0))
-        
-        feat_flatten = []
-        mask_flatten = []
-        spatial_shapes = []
-        for lvl, (feat, mask) in enumerate(
-                zip(mlvl_feats, mlvl_masks)):
-            bs, c, h, w = feat.shape
-            spatial_shape = (h, w)
-            spatial_shapes.append(spatial_shape)
-            feat = feat.flatten(2).transpose(1, 2)
-            mask = mask.flatten(1)
-            feat_flatten.append(feat)
-            mask_flatten.append(mask)
-        feat_flatten = torch.cat(feat_flatten, 1)
-        mask_flatten = torch.cat(mask_flatten, 1)
+
+        mask_flatten = torch.cat([mask.flatten(1) for mask in mlvl_masks], 1)
         spatial_shapes = torch.as_tensor(
-            spatial_shapes, dtype=torch.long, device=feat_flatten.device)
-        
+            [feat.shape[-2:] for feat in mlvl_feats],
+            dtype=torch.long, device=mask_flatten.device)
         level_start_index = torch.cat((spatial_shapes.new_zeros(
             (1, )), spatial_shapes.prod(1).cumsum(0)[:-1]))
         valid_ratios = torch.stack(
             [self.get_valid_ratio(m) for m in mlvl_masks], 1)
-        feat_flatten = feat_flatten.permute(1, 0, 2)
+
+        geometry = (mask_flatten, spatial_shapes, level_start_index,
+                    valid_ratios)
+        self.geometry_cache[key] = geometry
+        if len(self.geometry_cache) > 8:
+            self.geometry_cache.popitem(last=False)
+        return geometry
+
+    def flatten_img_features(self, mlvl_feats):
+        """The value of the decoder, all levels filled into one buffer.
+
+        Returns:
+            torch.Tensor: [BS, N_value, C] with batch first decoder layers,
+                else a [N_value, BS, C] view of it.
+        """
+        feat_flatten = torch.cat(
+            [feat.flatten(2).transpose(1, 2) for feat in mlvl_feats], 1)
+        return feat_flatten if self.batch_first else feat_flatten.transpose(
+            0, 1)
+
+    def prepare_decoder_inputs(self, 
+                               seeds_3d,
+                               mlvl_feats,
+                               img_metas,):
+        # get_reference_points
+        reference_points = self.get_reference_points(seeds_3d, img_metas)
+
+        mask_flatten, spatial_shapes, level_start_index, valid_ratios = \
+            self.get_decoder_geometry(mlvl_feats, img_metas)
+        feat_flatten = self.flatten_img_features(mlvl_feats)
 
         return feat_flatten, mask_flatten, reference_points,\
             spatial_shapes, level_start_index, valid_ratios
 
-    def loss(self, preds_all, targets, points):
-        losses_all = []
-        for preds in preds_all:
-            centerness = preds['centerness']
-            bbox_pred = preds['bbox_pred']
-            cls_scores = preds['cls_scores']
-            bbox_preds = (centerness, bbox_pred, cls_scores)
-            losses_all.append(self._loss(bbox_preds, targets, points))
-        
-        losses = dict()
-        assert self.num_fusion_layers + 1 == len(losses_all)
-        for k in losses_all[0]:
-            losses[k] = 0
-            for i in range(self.num_fusion_layers + 1):
-                losses[k] += losses_all[i][k] / (self.num_fusion_layers + 1)
-        return losses
-
-    def _loss(self, stage_preds, targets, points):
-        loss_centerness, loss_bbox, loss_cls = [], [], []
-        batch_size = points.shape[0]
-        for i in range(batch_size):
-            img_loss_centerness, img_loss_bbox, img_loss_cls = self._loss_single(
-                centerness=stage_preds[0][i],
-                bbox_preds=stage_preds[1][i],
-                cls_scores=stage_preds[2][i],
-                points=points[i],
-                centerness_targets=targets[0][i],
-                bbox_targets=targets[1][i],
-                labels=targets[2][i],
-            )
-            loss_centerness.append(img_loss_centerness)
-            loss_bbox.append(img_loss_bbox)
-            loss_cls.append(img_loss_cls)
-        return dict(
-            stage2_loss_centerness=torch.mean(torch.stack(loss_centerness)),
-            stage2_loss_bbox=torch.mean(torch.stack(loss_bbox)),
-            stage2_loss_cls=torch.mean(torch.stack(loss_cls))
-        )
+    def loss(self, preds_all, targets, points, valid_mask=None,
+             normalizer=None):
+        """Mean of the losses of the proposals and of every decoder layer.
+
+        The predictions of all layers are stacked layer-major and their
+        losses computed in one batched call, as if every layer of every
+        scene was a scene of its own, against the targets repeated per
+        layer.
+        """
+        n_layers = len(preds_all)
+        assert self.num_fusion_layers + 1 == n_layers
+
+        def repeat(x):
+            return x.repeat(n_layers, *[1] * (x.dim() - 1))
+
+        stage_preds = [
+            torch.cat([preds[k] for preds in preds_all])
+            for k in ('centerness', 'bbox_pred', 'cls_scores')
+        ]
+        return self._loss(
+            stage_preds, [repeat(target) for target in targets],
+            repeat(points), None if valid_mask is None else repeat(valid_mask),
+            normalizer)
 
     def get_bboxes(self, preds_all, points, img_metas,
-                   rescale=False):
+                   rescale=False, valid_mask=None):
         results_all = []
         for preds in preds_all:
+            if preds is None:
+                results_all.append(None)
+                continue
             results = []
             for i in range(len(img_metas)):
+                # drop the padded proposals
+                keep = slice(None) if valid_mask is None else valid_mask[i]
                 result = self._get_bboxes_single(
-                    centernesses=preds['centerness'][i],
-                    bbox_preds=preds['bbox_pred'][i],
-                    cls_scores=preds['cls_scores'][i],
-                    points=points[i],
+                    centernesses=preds['centerness'][i][keep],
+                    bbox_preds=preds['bbox_pred'][i][keep],
+                    cls_scores=preds['cls_scores'][i][keep],
+                    points=points[i][keep],
                     img_meta=img_metas[i]
                 )
                 results.append(result)
@@ -462,95 +625,19 @@ class CAHeadIter(CAHead):
 
 @HEADS.register_module()
 class CAHeadGridOffset(CAHeadIter):
-    def transformer_decoder(self, 
-                            features,
-                            points,
-                            img_features,
-                            img_metas,
-                            ):
-        decode_res_all = []
-
-        # get proposals
-        predictions = self.conv_preds[0](features)
-        decode_res = self.split_pred(predictions, points)
-        decode_res_all.append(decode_res)
-
-        # get inputs
-        feat_flatten, mask_flatten, reference_points, spatial_shapes,\
-            level_start_index, valid_ratios = self.prepare_decoder_inputs(
-                points, img_features, img_metas)
-
-        query = features.permute(2, 0, 1)
-        for i in range(self.num_decoder_layers):
-            query_pos = torch.cat(
-                [decode_res['distance'], decode_res['ref_points']], 
-                dim=-1).detach().clone()
-            query = self.decoder[i](
-                query=query,  # [N_query, BS, C_query]
-                key=None,
-                value=feat_flatten,  # [N_value, BS, C_value]
-                query_pos=query_pos,  # [N_query, BS, C_query]
-                key_padding_mask=mask_flatten,  # [BS, N_value]
-                reference_points=reference_points,  # [BS, N_query, 2]
-                spatial_shapes=spatial_shapes,  # [N_lvl, 2]
-                level_start_index=level_start_index,  # [N_lvl]
-                valid_ratios=valid_ratios,  # [BS, N_lvl, 2]
-                img_features=img_features,
-            )
-
-            predictions = self.conv_preds[i+1](query.permute(1, 2, 0))
-            decode_res = self.split_pred(predictions, points)
-            decode_res_all.append(decode_res)            
-
-        return decode_res_all
+    def decoder_extra_inputs(self, img_features, reference_points,
+                             valid_ratios):
+        return dict(img_features=img_features)
 
 
 @HEADS.register_module()
 class CAHeadIterOffset(CAHeadIter):
-    def transformer_decoder(self, 
-                            features,
-                            points,
-                            img_features,
-                            img_metas,
-                            ):
-        decode_res_all = []
-
-        # get proposals
-        predictions = self.conv_preds[0](features)
-        decode_res = self.split_pred(predictions, points)
-        decode_res_all.append(decode_res)
-
-        # get inputs
-        feat_flatten, mask_flatten, reference_points, spatial_shapes,\
-            level_start_index, valid_ratios = self.prepare_decoder_inputs(
-                points, img_features, img_metas)
+    def decoder_extra_inputs(self, img_features, reference_points,
+                             valid_ratios):
         offset_features = self.get_offset_features(
             reference_points, img_features, valid_ratios)
-        offset_features = offset_features.permute(0, 2, 1)
-
-        query = features.permute(2, 0, 1)
-        for i in range(self.num_decoder_layers):
-            query_pos = torch.cat(
-                [decode_res['distance'], decode_res['ref_points']], 
-                dim=-1).detach().clone()
-            query = self.decoder[i](
-                query=query,  # [N_query, BS, C_query]
-                key=None,
-                value=feat_flatten,  # [N_value, BS, C_value]
-                query_pos=query_pos,  # [N_query, BS, C_query]
-                key_padding_mask=mask_flatten,  # [BS, N_value]
-                reference_points=reference_points,  # [BS, N_query, 2]
-                spatial_shapes=spatial_shapes,  # [N_lvl, 2]
-                level_start_index=level_start_index,  # [N_lvl]
-                valid_ratios=valid_ratios,  # [BS, N_lvl, 2]
-                offset_features=offset_features,  # [BS, N_query, C_query]
-            )
-
-            predictions = self.conv_preds[i+1](query.permute(1, 2, 0))
-            decode_res = self.split_pred(predictions, points)
-            decode_res_all.append(decode_res)            
-
-        return decode_res_all
+        # [BS, N_query, C_query]
+        return dict(offset_features=offset_features.permute(0, 2, 1))
 
     def get_offset_features(self, reference_points, img_features, valid_ratios):
         used_features = img_features[0]
@@ -582,7 +669,8 @@ class CAHeadIterOffsetRefPoint(CAHeadIterOffset):
                      use_sigmoid=True,
                      gamma=2.0,
                      alpha=0.25,
-                     loss_weight=1.0),):
+                     loss_weight=1.0),
+                 num_proposals=256):
         nn.Module.__init__(self)
         self.upsample_layer = nn.Conv1d(128, 256, kernel_size=1)
         
@@ -599,16 +687,22 @@ class CAHeadIterOffsetRefPoint(CAHeadIterOffset):
                 nn.Conv1d(256, 19, kernel_size=1)
             )
 
-        self.query_embedding = nn.Embedding(256, 256)
+        # one learned reference point per proposal slot, must match
+        # num_proposals of the neck
+        self.query_embedding = nn.Embedding(num_proposals, 256)
         self.reference_points = nn.Linear(256, 2)
         
         self.loss_centerness = build_loss(loss_centerness)
         self.loss_bbox = build_loss(loss_bbox)
         self.loss_cls = build_loss(loss_cls)
         self.yaw_parametrization = yaw_parametrization
+        # decoder inputs that only depend on the image shapes
+        self.geometry_cache = OrderedDict()
 
     def get_reference_points(self, seeds_3d_batch, img_metas):
-        bs, _, _ = seeds_3d_batch.shape
+        bs, num_proposals, _ = seeds_3d_batch.shape
+        assert num_proposals == self.query_embedding.num_embeddings, \
+            'num_proposals of the head and of the neck differ'
         query_embeds = self.query_embedding.weight
         query_embeds = query_embeds.unsqueeze(0).expand(bs, -1, -1)
         reference_points = self.reference_points(query_embeds).sigmoid()
@@ -654,28 +748,11 @@ class CAHeadIterOffsetRefPointRefine(CAHeadIterOffset):
         self.loss_bbox = build_loss(loss_bbox)
         self.loss_cls = build_loss(loss_cls)
         self.yaw_parametrization = yaw_parametrization
+        # decoder inputs that only depend on the image shapes
+        self.geometry_cache = OrderedDict()
 
     def get_reference_points(self, seeds_3d_batch, img_metas, img_features, valid_ratios, spatial_shapes):
-        uv_all = []
-        for seeds_3d, img_meta in zip(seeds_3d_batch, img_metas):
-            img_shape = img_meta['img_shape']
-            
-            # first reverse the data transformations
-            xyz_depth = apply_3d_transformation(
-                seeds_3d, 'DEPTH', img_meta, reverse=True)
-            
-            # project points from depth to image
-            depth2img = xyz_depth.new_tensor(img_meta['depth2img'])
-            uv_origin = points_cam2img(xyz_depth, depth2img, False)
-            
-            # transform and normalize 2d coordinates
-            uv_transformed = coord_2d_transform(img_meta, uv_origin, True)
-            uv_transformed[:, 0] = uv_transformed[:, 0] / (img_shape[1] - 1)
-            uv_transformed[:, 1] = uv_transformed[:, 1] / (img_shape[0] - 1)
-            uv_transformed = torch.clamp(uv_transformed, 0, 1)
-            
-            uv_all.append(uv_transformed)
-        uv_all = torch.stack(uv_all, dim=0)
+        uv_all = self.project_to_img(seeds_3d_batch, img_metas)
 
         refine_features = self.get_offset_features(uv_all, img_features, valid_ratios)
         refine = self.reference_points_refine(refine_features.permute(0, 2, 1))
@@ -689,42 +766,9 @@ class CAHeadIterOffsetRefPointRefine(CAHeadIterOffset):
                                seeds_3d,
                                mlvl_feats,
                                img_metas,):
-        # get masks
-        batch_size = mlvl_feats[0].size(0)
-        input_img_h, input_img_w = img_metas[0]['batch_input_shape']
-        img_masks = mlvl_feats[0].new_ones(
-            (batch_size, input_img_h, input_img_w))
-        for img_id in range(batch_size):
-            img_h, img_w, _ = img_metas[img_id]['img_shape']
-            img_masks[img_id, :img_h, :img_w] = 0
-        mlvl_masks = []
-        for feat in mlvl_feats:
-            mlvl_masks.append(
-                F.interpolate(img_masks[None],
-                              size=feat.shape[-2:]).to(torch.bool).squeeze(0))
-        
-        feat_flatten = []
-        mask_flatten = []
-        spatial_shapes = []
-        for lvl, (feat, mask) in enumerate(
-                zip(mlvl_feats, mlvl_masks)):
-            bs, c, h, w = feat.shape
-            spatial_shape = (h, w)
-            spatial_shapes.append(spatial_shape)
-            feat = feat.flatten(2).transpose(1, 2)
-            mask = mask.flatten(1)
-            feat_flatten.append(feat)
-            mask_flatten.append(mask)
-        feat_flatten = torch.cat(feat_flatten, 1)
-        mask_flatten = torch.cat(mask_flatten, 1)
-        spatial_shapes = torch.as_tensor(
-            spatial_shapes, dtype=torch.long, device=feat_flatten.device)
-        
-        level_start_index = torch.cat((spatial_shapes.new_zeros(
-            (1, )), spatial_shapes.prod(1).cumsum(0)[:-1]))
-        valid_ratios = torch.stack(
-            [self.get_valid_ratio(m) for m in mlvl_masks], 1)
-        feat_flatten = feat_flatten.permute(1, 0, 2)
+        mask_flatten, spatial_shapes, level_start_index, valid_ratios = \
+            self.get_decoder_geometry(mlvl_feats, img_metas)
+        feat_flatten = self.flatten_img_features(mlvl_feats)
 
         # get_reference_points
         reference_points = self.get_reference_points(seeds_3d, img_metas, mlvl_feats, valid_ratios, spatial_shapes)
@@ -740,13 +784,19 @@ class CAHeadOffset(CAHeadIterOffset):
                             points,
                             img_features,
                             img_metas,
+                            pred_layers=None,
+                            valid_mask=None,
                             ):
-        decode_res_all = []
+        if pred_layers is None:
+            pred_layers = range(self.num_decoder_layers + 1)
+        last_layer = max(pred_layers, default=-1)
+        decode_res_all = [None] * (self.num_decoder_layers + 1)
 
-        # get proposals
-        predictions = self.conv_preds[0](features)
-        decode_res = self.split_pred(predictions, points)
-        decode_res_all.append(decode_res)
+        # get proposals, no query position embedding depends on them
+        if 0 in pred_layers:
+            decode_res_all[0] = self.predict(0, features, points)
+        if last_layer <= 0:
+            return decode_res_all
 
         # get inputs
         feat_flatten, mask_flatten, reference_points, spatial_shapes,\
@@ -756,15 +806,18 @@ class CAHeadOffset(CAHeadIterOffset):
             reference_points, img_features, valid_ratios)
         offset_features = offset_features.permute(0, 2, 1)
 
-        query = features.permute(2, 0, 1)
-        for i in range(self.num_decoder_layers):
+        query_key_padding_mask = get_key_padding_mask(valid_mask)
+        # a view, [BS, N_query, C] or [N_query, BS, C]
+        query = features if self.batch_first else features.transpose(0, 1)
+        for i in range(last_layer):
             query_pos = None
             query = self.decoder[i](
-                query=query,  # [N_query, BS, C_query]
+                query=query,
                 key=None,
-                value=feat_flatten,  # [N_value, BS, C_value]
+                value=feat_flatten,
                 query_pos=query_pos,  # [N_query, BS, C_query]
                 key_padding_mask=mask_flatten,  # [BS, N_value]
+                query_key_padding_mask=query_key_padding_mask,  # [BS, N_query]
                 reference_points=reference_points,  # [BS, N_query, 2]
                 spatial_shapes=spatial_shapes,  # [N_lvl, 2]
                 level_start_index=level_start_index,  # [N_lvl]
@@ -772,9 +825,11 @@ class CAHeadOffset(CAHeadIterOffset):
                 offset_features=offset_features,  # [BS, N_query, C_query]
             )
 
-            predictions = self.conv_preds[i+1](query.permute(1, 2, 0))
-            decode_res = self.split_pred(predictions, points)
-            decode_res_all.append(decode_res)            
+            if i + 1 in pred_layers:
+                decode_res_all[i + 1] = self.predict(
+                    i + 1,
+                    query if self.batch_first else query.transpose(0, 1),
+                    points)
 
         return decode_res_all
 
@@ -811,13 +866,18 @@ class CAHeadOffsetNoAug(CAHeadIter):
         self.loss_bbox = build_loss(loss_bbox)
         self.loss_cls = build_loss(loss_cls)
         self.yaw_parametrization = yaw_parametrization
+        # decoder inputs that only depend on the image shapes
+        self.geometry_cache = OrderedDict()
 
     def transformer_decoder(self, 
                             features,
                             points,
                             img_features,
                             img_metas,
+                            pred_layers=None,
+                            valid_mask=None,
                             ):
+        # a single prediction after the last layer, pred_layers is unused
         # get inputs
         feat_flatten, mask_flatten, reference_points, spatial_shapes,\
             level_start_index, valid_ratios = self.prepare_decoder_inputs(
@@ -826,14 +886,17 @@ class CAHeadOffsetNoAug(CAHeadIter):
             reference_points, img_features, valid_ratios)
         offset_features = offset_features.permute(0, 2, 1)
 
-        query = features.permute(2, 0, 1)
+        query_key_padding_mask = get_key_padding_mask(valid_mask)
+        # a view, [BS, N_query, C] or [N_query, BS, C]
+        query = features if self.batch_first else features.transpose(0, 1)
         for i in range(self.num_decoder_layers):
             query = self.decoder[i](
-                query=query,  # [N_query, BS, C_query]
+                query=query,
                 key=None,
-                value=feat_flatten,  # [N_value, BS, C_value]
+                value=feat_flatten,
                 query_pos=None,  # [N_query, BS, C_query]
                 key_padding_mask=mask_flatten,  # [BS, N_value]
+                query_key_padding_mask=query_key_padding_mask,  # [BS, N_query]
                 reference_points=reference_points,  # [BS, N_query, 2]
                 spatial_shapes=spatial_shapes,  # [N_lvl, 2]
                 level_start_index=level_start_index,  # [N_lvl]
@@ -841,8 +904,10 @@ class CAHeadOffsetNoAug(CAHeadIter):
                 offset_features=offset_features,  # [BS, N_query, C_query]
             )  
 
-        predictions = self.conv_pred(query.permute(1, 2, 0))
-        decode_res = self.split_pred(predictions, points)        
+        predictions = self.pointwise(
+            self.conv_pred,
+            query if self.batch_first else query.transpose(0, 1))
+        decode_res = self.split_pred(predictions, points)
 
         return decode_res
 
@@ -860,23 +925,26 @@ class CAHeadOffsetNoAug(CAHeadIter):
         offset_features = offset_features.squeeze(dim=3)
         return offset_features
 
-    def loss(self, preds, targets, points):
+    def loss(self, preds, targets, points, valid_mask=None,
+             normalizer=None):
         centerness = preds['centerness']
         bbox_pred = preds['bbox_pred']
         cls_scores = preds['cls_scores']
         bbox_preds = (centerness, bbox_pred, cls_scores)
-        losses = self._loss(bbox_preds, targets, points)
+        losses = self._loss(
+            bbox_preds, targets, points, valid_mask, normalizer)
         return losses
 
     def get_bboxes(self, preds, points, img_metas,
-                   rescale=False):
+                   rescale=False, valid_mask=None):
         results = []
         for i in range(len(img_metas)):
+            keep = slice(None) if valid_mask is None else valid_mask[i]
             result = self._get_bboxes_single(
-                centernesses=preds['centerness'][i],
-                bbox_preds=preds['bbox_pred'][i],
-                cls_scores=preds['cls_scores'][i],
-                points=points[i],
+                centernesses=preds['centerness'][i][keep],
+                bbox_preds=preds['bbox_pred'][i][keep],
+                cls_scores=preds['cls_scores'][i][keep],
+                points=points[i][keep],
                 img_meta=img_metas[i]
             )
             results.append(result)
@@ -894,6 +962,8 @@ class GLFF3DNeckWithHead(nn.Module):
                  pts_threshold,
                  assigner,
                  yaw_parametrization='fcaf3d',
+                 num_proposals=256,
+                 proposal_score_thr=None,
                  loss_centerness=dict(
                      type='CrossEntropyLoss',
                      use_sigmoid=True,
@@ -908,6 +978,12 @@ class GLFF3DNeckWithHead(nn.Module):
                  train_cfg=None,
                  test_cfg=None):
         super(GLFF3DNeckWithHead, self).__init__()
+        # at most num_proposals voxels of every scene go to the second stage,
+        # with a proposal_score_thr only the ones scoring above it
+        self.num_proposals = num_proposals
+        self.proposal_score_thr = proposal_score_thr
+        # proposal scores of the current forward, see _proposal_scores
+        self._score_cache = None
         self.voxel_size = voxel_size
         self.yaw_parametrization = yaw_parametrization
         self.assigner = build_assigner(assigner)
@@ -966,9 +1042,17 @@ class GLFF3DNeckWithHead(nn.Module):
         nn.init.normal_(self.cls_conv.kernel, std=.01)
         nn.init.constant_(self.cls_conv.bias, bias_init_with_prob(.01))
 
-    def forward(self, x):
+    def forward(self, x, batch_size=None):
+        """Predict on all levels and select the stage-2 proposals.
+
+        Args:
+            x (list[SparseTensor]): Backbone features of every level.
+            batch_size (int, optional): Number of scenes. Inferred from the
+                batch indices if None, which misses trailing scenes without
+                any voxel.
+        """
+        self._score_cache = None
         outs = []
-        outs_features = []
         inputs = x
         x = inputs[-1]
         for i in range(len(inputs) - 1, -1, -1):
@@ -980,61 +1064,143 @@ class GLFF3DNeckWithHead(nn.Module):
             out = self.__getattr__(f'out_block_{i}')(x)
             out = self.forward_single(out, self.scales[i])
             scores = out[-1]
-            outs_features.append(out[-2])
-            outs.append(out[:-2])
-        
-        batch_size = len(outs[-1][0])
+            outs.append(out[:-1])
+
         # turned to scale 1 to 4, 1 is the max scale
-        outs = outs[::-1]
-        outs_features = outs_features[::-1]
-        points = []
-        features = []
-        sort_inds = []
-        for i in range(batch_size):
-            _centernesses = [out[0][i] for out in outs]
-            _cls_scores = [out[2][i] for out in outs]
-            _points = [out[3][i] for out in outs]
-            _features = [out[i] for out in outs_features]
-            _centernesses = torch.cat(_centernesses, dim=0).squeeze()
-            _cls_scores = torch.cat(_cls_scores, dim=0)
-            _points = torch.cat(_points, dim=0)
-            _features = torch.cat(_features, dim=0)
-            # select topk
-            select_scores = _cls_scores.sigmoid() * _centernesses.sigmoid().unsqueeze(dim=-1)
-            max_scores, _ = select_scores.max(dim=1)
-            max_k = max_scores.shape[0]
-            top_k = min(max_k, 256)
-            # top_k = min(max_k, 512)
-            # if top_k<2000:
-            #     print(top_k)
-            inds = torch.topk(max_scores, top_k)[1]
-            _sort_inds = torch.sort(inds)[0]
-            features.append(_features[_sort_inds])
-            points.append(_points[_sort_inds])
-            sort_inds.append(_sort_inds)
-        
-        features = torch.stack(features, dim=0)
-        sort_inds = torch.stack(sort_inds, dim=0)
-        points = torch.stack(points, dim=0)
-        
-        # return zip(*outs[::-1])
-        return zip(*outs), (points, features, sort_inds)
+        (centernesses, bbox_preds, cls_scores, points, features), counts = \
+            self._pack(outs[::-1], batch_size)
+        _, max_scores, _ = self._proposal_scores(centernesses, cls_scores)
+        rows, valid_mask = self._select(max_scores, counts.sum(dim=1))
+        scene_starts = counts.sum(dim=1).cumsum(0) - counts.sum(dim=1)
+        sort_inds = rows - scene_starts.unsqueeze(1)
+
+        return (centernesses, bbox_preds, cls_scores, points, counts), \
+            (points[rows], features[rows], sort_inds, valid_mask)
+
+    def _proposal_scores(self, centernesses, cls_scores):
+        """Class scores of the packed voxels, with their max and argmax.
+
+        At test time they are computed once per forward and shared by the
+        proposal selection and get_bboxes, which receives the same packed
+        tensors. Training does not call get_bboxes, so nothing is kept.
+        """
+        cache = self._score_cache
+        if cache is not None and cache[0] is cls_scores \
+                and cache[1] is centernesses:
+            return cache[2]
+        with torch.no_grad():
+            scores = cls_scores.sigmoid().mul_(centernesses.sigmoid())
+            max_scores, labels = scores.max(dim=1)
+        if not self.training:
+            self._score_cache = (cls_scores, centernesses,
+                                 (scores, max_scores, labels))
+        return scores, max_scores, labels
+
+    def _select(self, scores, scene_counts):
+        """Select the proposals of all scenes with one segmented top-k.
+
+        Args:
+            scores (torch.Tensor): Packed proposal scores with shape (M,).
+            scene_counts (torch.Tensor): Number of rows of every scene with
+                shape (B,).
+
+        Returns:
+            tuple[torch.Tensor]: Packed rows of the selected proposals with
+                shape (B, num_proposals), every scene in increasing row
+                order, and which of them are valid. Scenes with fewer
+                proposals are padded with their best one, which stays valid
+                so that every scene has at least one. Scenes without rows
+                have all their slots invalid, on a placeholder row.
+        """
+        with torch.no_grad():
+            batch_size = len(scene_counts)
+            n_rows = len(scores)
+            device = scores.device
+            batch_ids = torch.repeat_interleave(
+                torch.arange(batch_size, device=device), scene_counts)
+            starts = scene_counts.cumsum(0) - scene_counts
+            # order the rows by scene, then by decreasing score
+            positions = torch.arange(n_rows, device=device)
+            order = scores.argsort(descending=True)
+            order = order[(batch_ids[order] * n_rows + positions).argsort()]
+            ranks = positions - starts[batch_ids[order]]
+            keep = ranks < self.num_proposals
+            if self.proposal_score_thr is not None:
+                keep &= (scores[order] > self.proposal_score_thr) | (ranks == 0)
+            selected = torch.zeros_like(keep)
+            selected[order[keep]] = True
+            selected = torch.nonzero(selected).squeeze(1)
+            selected_ids = batch_ids[selected]
+            n_selected = torch.bincount(selected_ids, minlength=batch_size)
+            slots = torch.arange(len(selected), device=device) - (
+                n_selected.cumsum(0) - n_selected)[selected_ids]
+            # best row of every scene, empty scenes have none
+            best = order[starts.clamp(max=max(n_rows - 1, 0))]
+            best = best.masked_fill(scene_counts == 0, 0)
+            rows = best.unsqueeze(1).repeat(1, self.num_proposals)
+            rows[selected_ids, slots] = selected
+            valid_mask = torch.zeros_like(rows, dtype=torch.bool)
+            valid_mask[selected_ids, slots] = True
+        return rows, valid_mask
+
+    @staticmethod
+    def _pack(level_outs, batch_size=None):
+        """Pack the outputs of all levels scene-major.
+
+        Args:
+            level_outs (list[tuple[torch.Tensor]]): Outputs of every level,
+                the batch index of every row last.
+            batch_size (int, optional): Number of scenes, including the
+                empty ones. Default: the largest batch index plus one.
+
+        Returns:
+            tuple: Outputs of all levels, ordered by scene, then level, and
+                the number of rows of every scene at every level with shape
+                (B, L). A scene is a contiguous block of rows, and within it
+                a level is one too.
+        """
+        n_levels = len(level_outs)
+        batch_ids = torch.cat([out[-1] for out in level_outs])
+        level_ids = torch.cat([
+            torch.full_like(out[-1], i) for i, out in enumerate(level_outs)
+        ])
+        n_rows = len(batch_ids)
+        if batch_size is None:
+            batch_size = int(batch_ids.max()) + 1
+        # rows are already level-major, a stable sort by scene is enough
+        order = (batch_ids * n_rows + torch.arange(
+            n_rows, device=batch_ids.device)).argsort()
+        counts = torch.bincount(
+            batch_ids * n_levels + level_ids,
+            minlength=batch_size * n_levels).view(batch_size, n_levels)
+        packed = tuple(
+            torch.cat([out[k] for out in level_outs])[order]
+            for k in range(len(level_outs[0]) - 1))
+        return packed, counts
 
     def _prune(self, x, scores):
         if self.pts_threshold < 0:
             return x
 
         with torch.no_grad():
+            batch_ids = x.C[:, 0].long()
+            counts = torch.bincount(batch_ids)
+            if counts.max() <= self.pts_threshold:
+                return x
+            # the scores are at the coarser level, so they are still
+            # interpolated at the voxels of x
             coordinates = x.C.float()
             interpolated_scores = scores.features_at_coordinates(coordinates)
-            prune_mask = interpolated_scores.new_zeros((len(interpolated_scores)), dtype=torch.bool)
-            for permutation in x.decomposition_permutations:
-                score = interpolated_scores[permutation]
-                mask = score.new_zeros((len(score)), dtype=torch.bool)
-                topk = min(len(score), self.pts_threshold)
-                ids = torch.topk(score.squeeze(1), topk, sorted=False).indices
-                mask[ids] = True
-                prune_mask[permutation[mask]] = True
+            # segmented top-k: order the voxels by scene, then by decreasing
+            # score, and keep the first pts_threshold of every scene
+            n_voxels = len(batch_ids)
+            order = interpolated_scores.squeeze(1).argsort(descending=True)
+            positions = torch.arange(n_voxels, device=batch_ids.device)
+            order = order[(batch_ids[order] * n_voxels + positions).argsort()]
+            starts = counts.cumsum(0) - counts
+            ranks = positions - starts[batch_ids[order]]
+            prune_mask = torch.zeros_like(batch_ids, dtype=torch.bool)
+            prune_mask[order[ranks < self.pts_threshold]] = True
         x = self.pruning(x, prune_mask)
         return x
 
@@ -1043,98 +1209,71 @@ class GLFF3DNeckWithHead(nn.Module):
              bbox_preds,
              cls_scores,
              points,
+             counts,
              gt_bboxes,
              gt_labels,
-             img_metas):
-        assert len(centernesses[0]) == len(bbox_preds[0]) == len(cls_scores[0]) \
-               == len(points[0]) == len(img_metas) == len(gt_bboxes) == len(gt_labels)
-
-        loss_centerness, loss_bbox, loss_cls = [], [], []
+             img_metas,
+             normalizer=None):
+        """Losses and targets of the packed outputs.
+
+        With a ``normalizer`` the losses are only added to it and the
+        returned dict is empty, see DeferredNormalizer. The centerness,
+        bbox and label targets are packed like the outputs.
+        """
+        assert len(counts) == len(img_metas) == len(gt_bboxes) == len(gt_labels)
+
+        scene_counts = counts.sum(dim=1).tolist()
+        level_counts = counts.tolist()
         targets = []
-        for i in range(len(img_metas)):
-            img_loss_centerness, img_loss_bbox, img_loss_cls, img_targets = self._loss_single(
-                centernesses=[x[i] for x in centernesses],
-                bbox_preds=[x[i] for x in bbox_preds],
-                cls_scores=[x[i] for x in cls_scores],
-                points=[x[i] for x in points],
-                img_meta=img_metas[i],
-                gt_bboxes=gt_bboxes[i],
-                gt_labels=gt_labels[i]
-            )
-            loss_centerness.append(img_loss_centerness)
-            loss_bbox.append(img_loss_bbox)
-            loss_cls.append(img_loss_cls)
-            targets.append(img_targets)
-        return dict(
-            loss_centerness=torch.mean(torch.stack(loss_centerness)),
-            loss_bbox=torch.mean(torch.stack(loss_bbox)),
-            loss_cls=torch.mean(torch.stack(loss_cls))
-        ), targets
-
-    # per image
-    def _loss_single(self,
-                     centernesses,
-                     bbox_preds,
-                     cls_scores,
-                     points,
-                     gt_bboxes,
-                     gt_labels,
-                     img_meta):
         with torch.no_grad():
-            centerness_targets, bbox_targets, labels = self.assigner.assign(points, gt_bboxes, gt_labels)
-
-        centerness = torch.cat(centernesses)
-        bbox_preds = torch.cat(bbox_preds)
-        cls_scores = torch.cat(cls_scores)
-        points = torch.cat(points)
-
-        # skip background
-        pos_inds = torch.nonzero(labels >= 0).squeeze(1)
-        n_pos = torch.tensor(len(pos_inds), dtype=torch.float, device=centerness.device)
-        n_pos = max(reduce_mean(n_pos), 1.)
-        loss_cls = self.loss_cls(cls_scores, labels, avg_factor=n_pos)
-        pos_centerness = centerness[pos_inds]
-        pos_bbox_preds = bbox_preds[pos_inds]
-        pos_centerness_targets = centerness_targets[pos_inds].unsqueeze(1)
-        pos_bbox_targets = bbox_targets[pos_inds]
-        # centerness weighted iou loss
-        centerness_denorm = max(
-            reduce_mean(pos_centerness_targets.sum().detach()), 1e-6)
-
-        if len(pos_inds) > 0:
-            pos_points = points[pos_inds]
-            loss_centerness = self.loss_centerness(
-                pos_centerness, pos_centerness_targets, avg_factor=n_pos
-            )
-            loss_bbox = self.loss_bbox(
-                self._bbox_pred_to_bbox(pos_points, pos_bbox_preds),
-                pos_bbox_targets,
-                weight=pos_centerness_targets.squeeze(1),
-                avg_factor=centerness_denorm
-            )
-        else:
-            loss_centerness = pos_centerness.sum()
-            loss_bbox = pos_bbox_preds.sum()
-        
-        targets = (centerness_targets, bbox_targets, labels)
-        return loss_centerness, loss_bbox, loss_cls, targets
+            for i, point in enumerate(points.split(scene_counts)):
+                targets.append(self.assigner.assign(
+                    list(point.split(level_counts[i])), gt_bboxes[i],
+                    gt_labels[i]))
+            centerness_targets, bbox_targets, labels = (
+                torch.cat(target) for target in zip(*targets))
+        batch_ids = torch.arange(
+            len(counts), device=points.device).repeat_interleave(
+                counts.sum(dim=1))
+        deferred = normalizer is not None
+        if not deferred:
+            normalizer = DeferredNormalizer()
+        batched_loss(
+            self,
+            centerness=centernesses,
+            bbox_preds=bbox_preds,
+            cls_scores=cls_scores,
+            points=points,
+            centerness_targets=centerness_targets,
+            bbox_targets=bbox_targets,
+            labels=labels,
+            batch_ids=batch_ids,
+            batch_size=len(counts),
+            normalizer=normalizer)
+        return dict() if deferred else normalizer.compute(), \
+            (centerness_targets, bbox_targets, labels)
 
     def get_bboxes(self,
                    centernesses,
                    bbox_preds,
                    cls_scores,
                    points,
+                   counts,
                    img_metas,
                    rescale=False):
-        assert len(centernesses[0]) == len(bbox_preds[0]) == len(cls_scores[0]) \
-               == len(points[0]) == len(img_metas)
+        assert len(counts) == len(img_metas)
+        scene_counts = counts.sum(dim=1).tolist()
+        level_counts = counts.tolist()
+        scores, max_scores, _ = self._proposal_scores(centernesses, cls_scores)
         results = []
-        for i in range(len(img_metas)):
+        for i, (bbox_pred, score, max_score, point) in enumerate(zip(
+                bbox_preds.split(scene_counts), scores.split(scene_counts),
+                max_scores.split(scene_counts), points.split(scene_counts))):
             result = self._get_bboxes_single(
-                centernesses=[x[i] for x in centernesses],
-                bbox_preds=[x[i] for x in bbox_preds],
-                cls_scores=[x[i] for x in cls_scores],
-                points=[x[i] for x in points],
+                bbox_preds=bbox_pred.split(level_counts[i]),
+                scores=score.split(level_counts[i]),
+                max_scores=max_score.split(level_counts[i]),
+                points=point.split(level_counts[i]),
                 img_meta=img_metas[i],
             )
             results.append(result)
@@ -1142,28 +1281,25 @@ class GLFF3DNeckWithHead(nn.Module):
 
     # per image
     def _get_bboxes_single(self,
-                           centernesses,
                            bbox_preds,
-                           cls_scores,
+                           scores,
+                           max_scores,
                            points,
                            img_meta,):
         mlvl_bboxes, mlvl_scores = [], []
-        for centerness, bbox_pred, cls_score, point in zip(
-            centernesses, bbox_preds, cls_scores, points
+        for bbox_pred, score, max_score, point in zip(
+            bbox_preds, scores, max_scores, points
         ):
-            scores = cls_score.sigmoid() * centerness.sigmoid()
-            max_scores, _ = scores.max(dim=1)
-
-            if len(scores) > self.test_cfg.nms_pre > 0:
-                _, ids = max_scores.topk(self.test_cfg.nms_pre)
+            if len(score) > self.test_cfg.nms_pre > 0:
+                _, ids = max_score.topk(self.test_cfg.nms_pre)
                 bbox_pred = bbox_pred[ids]
-                scores = scores[ids]
+                score = score[ids]
                 point = point[ids]
 
             bboxes = self._bbox_pred_to_bbox(point, bbox_pred)
             mlvl_bboxes.append(bboxes)
             # print(bboxes.shape)
-            mlvl_scores.append(scores)
+            mlvl_scores.append(score)
 
         bboxes = torch.cat(mlvl_bboxes)
         scores = torch.cat(mlvl_scores)
@@ -1185,18 +1321,11 @@ class GLFF3DNeckWithHead(nn.Module):
         reg_angle = reg_final[:, 6:]
         bbox_pred = torch.cat((reg_distance, reg_angle), dim=1)
 
-        centernesses, bbox_preds, cls_scores, points = [], [], [], []
-        for permutation in x.decomposition_permutations:
-            centernesses.append(centerness[permutation])
-            bbox_preds.append(bbox_pred[permutation])
-            cls_scores.append(cls_score[permutation])
+        points = x.C[:, 1:] * self.voxel_size
+        batch_ids = x.C[:, 0].long()
 
-        points = x.decomposed_coordinates
-        for i in range(len(points)):
-            points[i] = points[i] * self.voxel_size
-        features = x.decomposed_features
-
-        return centernesses, bbox_preds, cls_scores, points, features, prune_scores
+        return centerness, bbox_pred, cls_score, points, x.F, batch_ids, \
+            prune_scores
 
     def _bbox_pred_to_bbox(self, points, bbox_pred):
         if bbox_pred.shape[0] == 0:
@@ -1250,36 +1379,52 @@ class GLFF3DNeckWithHead(nn.Module):
             ), dim=-1)
 
     def _nms(self, bboxes, scores, img_meta):
-        n_classes = scores.shape[1]
-        yaw_flag = bboxes.shape[1] == 7
-        nms_bboxes, nms_scores, nms_labels = [], [], []
-        for i in range(n_classes):
-            ids = scores[:, i] > self.test_cfg.score_thr
-            if not ids.any():
-                continue
-
-            class_scores = scores[ids, i]
-            class_bboxes = bboxes[ids]
-            if yaw_flag:
-                nms_function = pcdet_nms_gpu
-            else:
-                class_bboxes = torch.cat((
-                    class_bboxes, torch.zeros_like(class_bboxes[:, :1])), dim=1)
-                nms_function = pcdet_nms_normal_gpu
-
-            nms_ids, _ = nms_function(class_bboxes, class_scores, self.test_cfg.iou_thr)
-            nms_bboxes.append(class_bboxes[nms_ids])
-            nms_scores.append(class_scores[nms_ids])
-            nms_labels.append(bboxes.new_full(class_scores[nms_ids].shape, i, dtype=torch.long))
-
-        if len(nms_bboxes):
-            nms_bboxes = torch.cat(nms_bboxes, dim=0)
-            nms_scores = torch.cat(nms_scores, dim=0)
-            nms_labels = torch.cat(nms_labels, dim=0)
-        else:
-            nms_bboxes = bboxes.new_zeros((0, bboxes.shape[1]))
-            nms_scores = bboxes.new_zeros((0,))
-            nms_labels = bboxes.new_zeros((0,))
+        return self._nms_batch([bboxes], [scores], [img_meta])[0]
+
+    def _nms_batch(self, bboxes, scores, img_metas):
+        """Multi-class NMS of a batch in a single NMS call.
+
+        Every (sample, class) pair is a separate NMS group. The kept boxes
+        of a sample are ordered by class, then by decreasing score, as
+        with one NMS call per class.
+
+        Args:
+            bboxes (list[torch.Tensor]): Boxes of every sample.
+            scores (list[torch.Tensor]): Class scores of every sample.
+            img_metas (list[dict]): Meta information of every sample.
+
+        Returns:
+            list[tuple]: Boxes, scores and labels of every sample.
+        """
+        n_classes = scores[0].shape[1]
+        yaw_flag = bboxes[0].shape[1] == 7
+        sample_ids = torch.cat([
+            torch.full((len(x), ), i, dtype=torch.long, device=x.device)
+            for i, x in enumerate(bboxes)
+        ])
+        bboxes = torch.cat(bboxes)
+        scores = torch.cat(scores)
+        if not yaw_flag:
+            bboxes = torch.cat((
+                bboxes, torch.zeros_like(bboxes[:, :1])), dim=1)
+
+        ids, labels = torch.nonzero(
+            scores > self.test_cfg.score_thr, as_tuple=True)
+        sample_ids = sample_ids[ids]
+        groups = sample_ids * n_classes + labels
+        nms_ids = batched_nms_3d(
+            bboxes[ids], scores[ids, labels], groups, self.test_cfg.iou_thr,
+            with_yaw=yaw_flag,
+            backend=self.test_cfg.get('nms_backend', 'auto'))
+        # nms_ids are sorted by score, sort them by group keeping that order
+        order = groups[nms_ids] * len(nms_ids) + torch.arange(
+            len(nms_ids), device=nms_ids.device)
+        nms_ids = nms_ids[order.argsort()]
+        ids, labels = ids[nms_ids], labels[nms_ids]
+        nms_scores = scores[ids, labels]
+        nms_bboxes = bboxes[ids]
+        counts = torch.bincount(
+            sample_ids[nms_ids], minlength=len(img_metas)).tolist()
 
         if yaw_flag:
             box_dim = 7
@@ -1288,7 +1433,14 @@ class GLFF3DNeckWithHead(nn.Module):
             box_dim = 6
             with_yaw = False
             nms_bboxes = nms_bboxes[:, :6]
-        nms_bboxes = img_meta['box_type_3d'](
-            nms_bboxes, box_dim=box_dim, with_yaw=with_yaw, origin=(.5, .5, .5))
-
-        return nms_bboxes, nms_scores, nms_labels
+        results = []
+        for img_meta, sample_bboxes, sample_scores, sample_labels in zip(
+                img_metas, nms_bboxes.split(counts), nms_scores.split(counts),
+                labels.split(counts)):
+            sample_bboxes = img_meta['box_type_3d'](
+                sample_bboxes,
+                box_dim=box_dim,
+                with_yaw=with_yaw,
+                origin=(.5, .5, .5))
+            results.append((sample_bboxes, sample_scores, sample_labels))
+        return results
@@ -1,8 +1,13 @@
-import MinkowskiEngine as ME
-
 from mmdet.models import DETECTORS
 from mmdet3d.models import build_backbone, build_head, builder
+from mmdet3d.models.utils.branch_runner import BranchRunner
+from mmdet3d.models.utils.deferred_norm import DeferredNormalizer
+from mmdet3d.models.utils.feature_cache import ImgFeatureCache
+from mmdet3d.models.utils.voxelize import batch_voxelize
 from mmdet3d.core import bbox3d2result
+from mmdet3d.core.bbox import bbox3d_mapping_back
+
+import warnings
 
 import torch
 
@@ -22,10 +27,19 @@ class LayerNorm(nn.Module):
         if self.data_format not in ["channels_last", "channels_first"]:
             raise NotImplementedError
         self.normalized_shape = (normalized_shape,)
+        self.deployed = False
+
+    def deploy(self):
+        """Normalize channels first inputs with the fused layer_norm kernel."""
+        self.deployed = True
 
     def forward(self, x):
         if self.data_format == "channels_last":
             return F.layer_norm(x, self.normalized_shape, self.weight, self.bias, self.eps)
+        elif self.deployed:
+            x = F.layer_norm(x.permute(0, 2, 3, 1), self.normalized_shape,
+                             self.weight, self.bias, self.eps)
+            return x.permute(0, 3, 1, 2)
         elif self.data_format == "channels_first":
             u = x.mean(1, keepdim=True)
             s = (x - u).pow(2).mean(1, keepdim=True)
@@ -67,7 +81,83 @@ class SA(nn.Module):
         # Activation
         self.act = nn.GELU()
 
+        # gather indices of the fused upsampling, per map size and device
+        self._upsample_index = {}
+        self.deployed = False
+
+    def deploy(self):
+        """Concatenate the depthwise conv weights once for inference."""
+        weight = torch.cat([mfr.weight for mfr in self.mfr]).detach()
+        bias = torch.cat([mfr.bias for mfr in self.mfr]).detach()
+        if self.deployed:
+            # refresh the buffers of a previous deploy
+            self.fused_weight, self.fused_bias = weight, bias
+        else:
+            self.register_buffer('fused_weight', weight, persistent=False)
+            self.register_buffer('fused_bias', bias, persistent=False)
+        self.deployed = True
+
     def forward(self, x):
+        """Fused forward, equivalent to :meth:`forward_loop`.
+
+        The full resolution chunk and the max pooled chunks are laid out
+        top-left on one canvas, so the depthwise convs of all levels run as
+        one grouped conv (zeros around a pooled map act as its padding),
+        and the nearest upsampling of all levels is one gather.
+        """
+        h, w = x.size()[-2:]
+        chunk_dim = x.size(1) // self.n_levels
+
+        xc = x.chunk(self.n_levels, dim=1)
+        canvas = [xc[0]]
+        # the pooling stays per level: adaptive bins of sizes not divisible
+        # by 2 ** i are not nested across levels, and gathering the windows
+        # of all levels at once costs up to 2 ** (n_levels - 1) + 1 copies of
+        # the input, more than the n_levels - 1 small kernel launches
+        for i in range(1, self.n_levels):
+            p_size = (h // 2 ** i, w // 2 ** i)
+            s = F.adaptive_max_pool2d(xc[i], p_size)
+            canvas.append(F.pad(s, (0, w - p_size[1], 0, h - p_size[0])))
+        canvas = torch.cat(canvas, dim=1)
+
+        if self.deployed:
+            weight, bias = self.fused_weight, self.fused_bias
+        else:
+            weight = torch.cat([mfr.weight for mfr in self.mfr])
+            bias = torch.cat([mfr.bias for mfr in self.mfr])
+        s = F.conv2d(canvas, weight, bias, padding=1, groups=weight.size(0))
+        index = self.get_upsample_index(h, w, chunk_dim, x.device)
+        s = s.flatten(2).gather(2, index.expand(x.size(0), -1, -1))
+
+        out = self.aggr(s.view_as(x))
+        out = self.act(out) * x
+        return out
+
+    def get_upsample_index(self, h, w, chunk_dim, device):
+        """Canvas position of every output pixel of every channel.
+
+        The source pixels of the nearest upsampling are obtained by
+        upsampling an arange with ``F.interpolate`` itself, so they follow
+        its rounding exactly.
+        """
+        key = (h, w, chunk_dim, device)
+        if key not in self._upsample_index:
+            index = [torch.arange(h * w, device=device)]
+            for i in range(1, self.n_levels):
+                p_h, p_w = h // 2 ** i, w // 2 ** i
+                rows = F.interpolate(
+                    torch.arange(p_h, device=device).float().view(
+                        1, 1, p_h, 1), size=(h, 1), mode='nearest')
+                cols = F.interpolate(
+                    torch.arange(p_w, device=device).float().view(
+                        1, 1, 1, p_w), size=(1, w), mode='nearest')
+                index.append((rows * w + cols).long().flatten())
+            index = torch.stack(index).repeat_interleave(chunk_dim, dim=0)
+            self._upsample_index[key] = index[None]
+        return self._upsample_index[key]
+
+    def forward_loop(self, x):
+        """Reference forward with one pooling, conv and upsampling per level."""
         h, w = x.size()[-2:]
 
         xc = x.chunk(self.n_levels, dim=1)
@@ -85,6 +175,8 @@ class SA(nn.Module):
         out = self.aggr(torch.cat(out, dim=1))
         out = self.act(out) * x
         return out
+
+
 class GMFE(nn.Module):
     def __init__(self, dim, ffn_scale=2.0):
         super().__init__()
@@ -97,12 +189,138 @@ class GMFE(nn.Module):
         x = self.SA(self.norm1(x)) + x
         x = self.CC(self.norm2(x)) + x
         return x
+
+
+def pack_aug_views(points, img_metas, imgs=None):
+    """Pack the test time augmented views of a batch into one batch.
+
+    Args:
+        points (list[list[torch.Tensor]]): Points of every view of every
+            sample, views first.
+        img_metas (list[list[dict]]): Meta information, views first.
+        imgs (list[torch.Tensor], optional): Images of every view with
+            shape (B, C, H, W). They are zero padded on the bottom right to
+            a common size. Default: None.
+
+    Returns:
+        tuple: Points, meta information and images of all the views.
+    """
+    points = [x for view_points in points for x in view_points]
+    img_metas = [x for view_metas in img_metas for x in view_metas]
+    if imgs is not None:
+        h = max(img.shape[-2] for img in imgs)
+        w = max(img.shape[-1] for img in imgs)
+        imgs = torch.cat([
+            F.pad(img, (0, w - img.shape[-1], 0, h - img.shape[-2]))
+            for img in imgs
+        ])
+    return points, img_metas, imgs
+
+
+def merge_aug_candidates(bboxes, scores, img_metas, n_samples):
+    """Map the candidates of packed views back and group them by sample.
+
+    Args:
+        bboxes (list[torch.Tensor]): Gravity centered boxes of every view.
+        scores (list[torch.Tensor]): Class scores of every view.
+        img_metas (list[dict]): Meta information of every view.
+        n_samples (int): Number of samples, views are packed view-major.
+
+    Returns:
+        tuple[list[torch.Tensor]]: Boxes in the original point cloud
+            coordinates and scores of every sample.
+    """
+    merged_bboxes = [[] for _ in range(n_samples)]
+    merged_scores = [[] for _ in range(n_samples)]
+    for i, (view_bboxes, view_scores, img_meta) in enumerate(
+            zip(bboxes, scores, img_metas)):
+        box_dim = view_bboxes.shape[1]
+        view_bboxes = img_meta['box_type_3d'](
+            view_bboxes,
+            box_dim=box_dim,
+            with_yaw=box_dim == 7,
+            origin=(.5, .5, .5))
+        view_bboxes = bbox3d_mapping_back(
+            view_bboxes, img_meta.get('pcd_scale_factor', 1.),
+            img_meta.get('pcd_horizontal_flip', False),
+            img_meta.get('pcd_vertical_flip', False))
+        view_bboxes = torch.cat(
+            (view_bboxes.gravity_center, view_bboxes.tensor[:, 3:box_dim]),
+            dim=1)
+        merged_bboxes[i % n_samples].append(view_bboxes)
+        merged_scores[i % n_samples].append(view_scores)
+    merged_bboxes = [torch.cat(x) for x in merged_bboxes]
+    merged_scores = [torch.cat(x) for x in merged_scores]
+    return merged_bboxes, merged_scores
+
+
+class CandidateTestMixin:
+    """Test functions of the detectors on top of their ``get_candidates``.
+
+    ``get_candidates`` returns the boxes and class scores of every sample
+    before NMS, which ``neck_with_head._nms_batch`` runs on.
+    """
+
+    @staticmethod
+    def ensemble_candidates(stage_results, stages, n_samples):
+        """Concatenate the candidates of the ensembled stages per sample.
+
+        Args:
+            stage_results (list[list[tuple] | None]): Boxes and scores of
+                every sample for every stage, None for the stages not run.
+            stages (list[int]): Indices of the ensembled stages.
+            n_samples (int): Number of samples.
+
+        Returns:
+            tuple[list[torch.Tensor]]: Boxes and scores of every sample.
+        """
+        batch_bboxes, batch_scores = [], []
+        for i in range(n_samples):
+            batch_bboxes.append(
+                torch.cat([stage_results[stage][i][0] for stage in stages]))
+            batch_scores.append(
+                torch.cat([stage_results[stage][i][1] for stage in stages]))
+        return batch_bboxes, batch_scores
+
+    def simple_test(self, points, img_metas, img=None, rescale=False):
+        """Test function without augmentaiton."""
+        bboxes, scores = self.get_candidates(points, img_metas, img, rescale)
+        # all classes of all images in one NMS call
+        bbox_list = self.neck_with_head._nms_batch(bboxes, scores, img_metas)
+        bbox_results = [
+            bbox3d2result(bboxes, scores, labels)
+            for bboxes, scores, labels in bbox_list
+        ]
+        return bbox_results
+
+    def aug_test(self, points, img_metas, imgs=None, rescale=False):
+        """Test function with test time augmentation.
+
+        All views of all samples go through the network as one batch, the
+        boxes are mapped back to the original point clouds and the views of
+        every sample are merged by the NMS.
+        """
+        n_samples = len(img_metas[0])
+        points, aug_metas, img = pack_aug_views(points, img_metas, imgs)
+        bboxes, scores = self.get_candidates(points, aug_metas, img, rescale)
+        bboxes, scores = merge_aug_candidates(
+            bboxes, scores, aug_metas, n_samples)
+        bbox_list = self.neck_with_head._nms_batch(
+            bboxes, scores, img_metas[0])
+        bbox_results = [
+            bbox3d2result(bboxes, scores, labels)
+            for bboxes, scores, labels in bbox_list
+        ]
+        return bbox_results
+
+
 @DETECTORS.register_module()
-class SingleStageSparse3DDetector(Base3DDetector):
+class SingleStageSparse3DDetector(CandidateTestMixin, Base3DDetector):
     def __init__(self,
                  backbone,
                  neck_with_head,
                  voxel_size,
+                 voxelize_mode='reference',
                  pretrained=False,
                  train_cfg=None,
                  test_cfg=None):
@@ -112,6 +330,7 @@ class SingleStageSparse3DDetector(Base3DDetector):
         neck_with_head.update(test_cfg=test_cfg)
         self.neck_with_head = build_head(neck_with_head)
         self.voxel_size = voxel_size
+        self.voxelize_mode = voxelize_mode
         self.train_cfg = train_cfg
         self.test_cfg = test_cfg
         self.init_weights()
@@ -123,12 +342,9 @@ class SingleStageSparse3DDetector(Base3DDetector):
 
     def extract_feat(self, points, img_metas):
         """Extract features from points."""
-        coordinates, features = ME.utils.batch_sparse_collate(
-            [(p[:, :3] / self.voxel_size, p[:, 3:] / 255.) for p in points],
-            device=points[0].device)
-        x = ME.SparseTensor(coordinates=coordinates, features=features)
+        x, _ = batch_voxelize(points, self.voxel_size, self.voxelize_mode)
         x = self.backbone(x)
-        x = self.neck_with_head(x)
+        x, _ = self.neck_with_head(x)
         return x
 
     def forward_train(self,
@@ -140,22 +356,16 @@ class SingleStageSparse3DDetector(Base3DDetector):
         losses = self.neck_with_head.loss(*x, gt_bboxes_3d, gt_labels_3d, img_metas)
         return losses
 
-    def simple_test(self, points, img_metas, imgs=None, rescale=False):
-        """Test function without augmentaiton."""
+    def get_candidates(self, points, img_metas, img=None, rescale=False):
+        """Boxes and class scores of every sample before NMS."""
         x = self.extract_feat(points, img_metas)
         bbox_list = self.neck_with_head.get_bboxes(*x, img_metas, rescale=rescale)
-        bbox_results = [
-            bbox3d2result(bboxes, scores, labels)
-            for bboxes, scores, labels in bbox_list
-        ]
-        return bbox_results
-
-    def aug_test(self, points, img_metas, imgs=None, rescale=False):
-        pass
+        bboxes, scores = zip(*bbox_list)
+        return list(bboxes), list(scores)
 
 
 @DETECTORS.register_module()
-class SingleStageSparse3DDetector_CA(Base3DDetector):
+class SingleStageSparse3DDetector_CA(CandidateTestMixin, Base3DDetector):
     def __init__(self,
                  backbone,
                  neck_with_head,
@@ -166,6 +376,9 @@ class SingleStageSparse3DDetector_CA(Base3DDetector):
                  img_encoder=None,
                  freeze_img_branch=False,
                  freeze_stage1=False,
+                 img_feat_cache=None,
+                 concurrent_branches=False,
+                 voxelize_mode='reference',
                  pretrained=False,
                  train_cfg=None,
                  test_cfg=None):
@@ -175,13 +388,14 @@ class SingleStageSparse3DDetector_CA(Base3DDetector):
         neck_with_head.update(test_cfg=test_cfg)
         self.neck_with_head = build_head(neck_with_head)
         self.voxel_size = voxel_size
+        self.voxelize_mode = voxelize_mode
         self.train_cfg = train_cfg
         self.test_cfg = test_cfg
-        # Initialize GFME modules for each scale
-        self.GFME1 = GFME(dim=256)  # Assuming the feature dimension is 256, adjust as necessary
-        self.GFME2 = GFME(dim=256)
-        self.GFME3 = GFME(dim=256)
-        self.GFME4 = GFME(dim=256)
+        # Initialize GMFE modules for each scale
+        self.GFME1 = GMFE(dim=256)  # Assuming the feature dimension is 256, adjust as necessary
+        self.GFME2 = GMFE(dim=256)
+        self.GFME3 = GMFE(dim=256)
+        self.GFME4 = GMFE(dim=256)
 
         self.fuse_img_features = None  
 
@@ -196,10 +410,22 @@ class SingleStageSparse3DDetector_CA(Base3DDetector):
         self.freeze_img_branch = freeze_img_branch
         if freeze_img_branch:
             self.freeze_img_branch_params()
+        self.img_feat_cache = None
+        if img_feat_cache is not None:
+            if freeze_img_branch:
+                self.img_feat_cache = ImgFeatureCache(**img_feat_cache)
+            else:
+                warnings.warn('img_feat_cache is ignored as the image branch '
+                              'is not frozen')
         if freeze_stage1:
             self.freeze_stage1_params()
         if stage2_head is not None:
             self.stage2_head = build_head(stage2_head)
+        self.branch_runner = None
+        if concurrent_branches:
+            runner_cfg = concurrent_branches \
+                if isinstance(concurrent_branches, dict) else dict()
+            self.branch_runner = BranchRunner(**runner_cfg)
 
     def freeze_stage1_params(self):
         for param in self.backbone.parameters():
@@ -220,14 +446,11 @@ class SingleStageSparse3DDetector_CA(Base3DDetector):
 
     def extract_feat(self, points, img_metas):
         """Extract features from points."""
-        coordinates, features = ME.utils.batch_sparse_collate(
-            [(p[:, :3] / self.voxel_size, p[:, 3:] / 255.) for p in points],
-            device=points[0].device)
-        x = ME.SparseTensor(coordinates=coordinates, features=features)
+        x, _ = batch_voxelize(points, self.voxel_size, self.voxelize_mode)
 
         x = self.backbone(x)
               
-        x, select_points = self.neck_with_head(x)
+        x, select_points = self.neck_with_head(x, len(points))
        
         return x, select_points
 
@@ -267,6 +490,13 @@ class SingleStageSparse3DDetector_CA(Base3DDetector):
     @torch.no_grad()
     def extract_img_feat(self, img, img_metas):
         """Directly extract features from the img backbone+neck."""
+        # a sparse encoder runs on the proposals, see extract_img_dict
+        encode = bool(self.img_encoder) and not self.sparse_img_encoder
+        cache_stage = 'encoded' if encode else 'pre_encoder'
+        if self.img_feat_cache is not None:
+            x = self.img_feat_cache.get(img_metas, img.device, cache_stage)
+            if x is not None:
+                return x
         x = self.img_backbone(img)
 
 
@@ -283,160 +513,167 @@ class SingleStageSparse3DDetector_CA(Base3DDetector):
         x = tuple(x)
         
 
-        if self.img_encoder:
+        if encode:
             x = self.img_encoder(x, img_metas)
+        if self.img_feat_cache is not None:
+            self.img_feat_cache.put(img_metas, x, cache_stage)
         return x
 
 
+    @property
+    def sparse_img_encoder(self):
+        """Whether the image encoder only encodes around the proposals."""
+        return getattr(getattr(self, 'img_encoder', None), 'sparse', False)
+
+    def extract_img_dict(self, img, img_metas, select_points=None):
+        """Extract image features and pack them for the stage-2 head.
+
+        A sparse image encoder encodes the features around the projections
+        of the selected proposals only.
+        """
+        if not self.with_img_backbone:
+            return None
+        img_features = self.extract_img_feat(img, img_metas)
+        if self.sparse_img_encoder:
+            proposal_uvs = self.stage2_head.project_to_img(
+                select_points[0], img_metas)
+            img_features = self.img_encoder(
+                img_features, img_metas, proposal_uvs=proposal_uvs)
+        return dict(
+            img_features=img_features,
+            img_metas=img_metas,
+        )
+
+    def run_branches(self, point_fn, img, img_metas):
+        """Run the point branch and the image branch.
+
+        The branches only meet at the stage-2 head, so with
+        ``concurrent_branches`` they run concurrently and the wall-clock
+        time saved is kept in ``self.branch_runner.last_timing``. A sparse
+        image encoder needs the selected proposals, which ``point_fn``
+        returns second, so the image branch then runs after it.
+
+        Returns:
+            tuple: Outputs of ``point_fn`` and the image dict.
+        """
+        if not self.with_img_backbone:
+            return point_fn(), None
+        batch_input_shape = tuple(img[0].size()[-2:])
+        for img_meta in img_metas:
+            img_meta['batch_input_shape'] = batch_input_shape
+        if self.sparse_img_encoder:
+            point_outs = point_fn()
+            return point_outs, self.extract_img_dict(
+                img, img_metas, point_outs[1])
+        if self.branch_runner is None:
+            return point_fn(), self.extract_img_dict(img, img_metas)
+        return self.branch_runner(
+            point_fn, lambda: self.extract_img_dict(img, img_metas),
+            img.device)
+
     def forward_train(self,
                       points,
                       gt_bboxes_3d,
                       gt_labels_3d,
                       img_metas,
                       img=None):
-        # 
-        x, select_points = self.extract_feat(points, img_metas)
-        
-
-        #
-        losses, targets = self.neck_with_head.loss(*x, gt_bboxes_3d, gt_labels_3d, img_metas)
-
-        
-        if self.with_img_backbone:
-            batch_input_shape = tuple(img[0].size()[-2:])
-            for img_meta in img_metas:
-                img_meta['batch_input_shape'] = batch_input_shape
-
-            
-            img_features = self.extract_img_feat(img, img_metas)
-            
-            img_dict = dict(
-                img_features=img_features,
-                img_metas=img_metas,
-            )
-        else:
-            img_dict = None
-       
+        # the losses of both stages are normalized with one all-reduce
+        normalizer = DeferredNormalizer()
+
+        def point_branch():
+            x, select_points = self.extract_feat(points, img_metas)
+            _, targets = self.neck_with_head.loss(
+                *x, gt_bboxes_3d, gt_labels_3d, img_metas,
+                normalizer=normalizer)
+            return targets, select_points, x[4].sum(dim=1)
+
+        (targets, select_points, scene_counts), img_dict = self.run_branches(
+            point_branch, img, img_metas)
         stage2_preds = self.stage2_head(select_points, img_dict)
-        
-
-        
-        stage2_targets = self.get_stage2_targets(targets, select_points[-1])
-        
-
-        
-        stage2_losses = self.stage2_head.loss(stage2_preds, stage2_targets, select_points[0])
-        
-
-        losses.update(stage2_losses)
-        
-
+        stage2_targets = self.get_stage2_targets(
+            targets, select_points[2], scene_counts)
+        self.stage2_head.loss(
+            stage2_preds, stage2_targets, select_points[0], select_points[3],
+            normalizer=normalizer)
+        losses = normalizer.compute()
+        if self.branch_runner is not None and img_dict is not None:
+            # logged only, keys without 'loss' are not optimized
+            losses['branch_time_saved'] = select_points[0].new_tensor(
+                self.branch_runner.last_timing['saved'])
         return losses
 
-    def get_stage2_targets(self, targets, sort_inds):
-        '''
-        targets[List(List)]: out length batch size, in length 3 which means centerness_targets, bbox_targets and labels
-        returns:
-            stage2_targets[List]: lengths which composed of selected centerness_targets, bbox_targets and labels
-            centerness_targets shape batch * N, bbox_targets shape batch * N * 8, labels shape batch * N
-            N is the number of points
-        '''
-        batch_size = len(targets)
-        centerness_targets, bbox_targets, labels = [], [], []
-        for i in range(batch_size):
-            targets_per_img, sort_inds_per_img = targets[i], sort_inds[i]
-            centerness_targets.append(targets_per_img[0][sort_inds_per_img])
-            bbox_targets.append(targets_per_img[1][sort_inds_per_img])
-            labels.append(targets_per_img[2][sort_inds_per_img])
-        centerness_targets = torch.stack(centerness_targets, dim=0)
-        bbox_targets = torch.stack(bbox_targets, dim=0)
-        labels = torch.stack(labels, dim=0)
-        return (centerness_targets, bbox_targets, labels)
-
-    def simple_test(self, points, img_metas, img=None, rescale=False):
-        """Test function without augmentaiton."""
-        x, select_points = self.extract_feat(points, img_metas)
-        stage1_results = self.neck_with_head.get_bboxes(*x, img_metas, rescale=rescale)
-        # img branch
-        if self.with_img_backbone:
-            batch_input_shape = tuple(img[0].size()[-2:])
-            for img_meta in img_metas:
-                img_meta['batch_input_shape'] = batch_input_shape
-            img_features = self.extract_img_feat(img, img_metas)
-            img_dict = dict(
-                img_features=img_features,
-                img_metas=img_metas,
-            )
-        else:
-            img_dict = None
+    def get_stage2_targets(self, targets, sort_inds, scene_counts):
+        """Targets of the selected proposals with one gather.
+
+        Args:
+            targets (tuple[torch.Tensor]): Packed centerness, bbox and label
+                targets of the neck.
+            sort_inds (torch.Tensor): Rows of the proposals within their
+                scene with shape (B, N).
+            scene_counts (torch.Tensor): Number of packed rows of every
+                scene with shape (B,).
+
+        Returns:
+            tuple[torch.Tensor]: Centerness targets with shape (B, N), bbox
+                targets with shape (B, N, 7) and labels with shape (B, N).
+        """
+        rows = sort_inds + (scene_counts.cumsum(0) - scene_counts).unsqueeze(1)
+        return tuple(target[rows] for target in targets)
+
+    def get_candidates(self, points, img_metas, img=None, rescale=False):
+        """Ensembled boxes and class scores of every sample before NMS."""
+        stages = self.test_cfg.ensemble_stages
+
+        def point_branch():
+            x, select_points = self.extract_feat(points, img_metas)
+            stage1_results = None
+            if 0 in stages:
+                stage1_results = self.neck_with_head.get_bboxes(
+                    *x, img_metas, rescale=rescale)
+            return stage1_results, select_points
+
+        (stage1_results, select_points), img_dict = self.run_branches(
+            point_branch, img, img_metas)
         stage2_preds = self.stage2_head(select_points, img_dict)
-        stage2_results = self.stage2_head.get_bboxes(stage2_preds, select_points[0], img_metas, rescale=rescale)
-        bbox_list = []
-        # per image
-        for i in range(len(stage2_results)):
-            results = [stage1_results[i], stage2_results[i]]
-            ensemble_bboxes, ensemble_scores = [], []
-            for stage in self.test_cfg.ensemble_stages:
-                ensemble_bboxes.append(results[stage][0])
-                ensemble_scores.append(results[stage][1])
-            ensemble_bboxes = torch.cat(ensemble_bboxes, dim=0)
-            ensemble_scores = torch.cat(ensemble_scores, dim=0)
-            nms_process = self.neck_with_head._nms(ensemble_bboxes, ensemble_scores, img_metas[i])
-            bbox_list.append(nms_process)
-        bbox_results = [
-            bbox3d2result(bboxes, scores, labels)
-            for bboxes, scores, labels in bbox_list
-        ]
-        return bbox_results
-
-    def aug_test(self, points, img_metas, imgs=None, rescale=False):
-        pass
+        stage2_results = self.stage2_head.get_bboxes(
+            stage2_preds, select_points[0], img_metas, rescale=rescale,
+            valid_mask=select_points[3])
+        return self.ensemble_candidates(
+            [stage1_results, stage2_results], stages, len(img_metas))
 
 
 @DETECTORS.register_module()
 class TwoStageSparse3DDetector(SingleStageSparse3DDetector_CA):
-    def simple_test(self, points, img_metas, img=None, rescale=False):
-        """Test function without augmentaiton."""
-        x, select_points = self.extract_feat(points, img_metas)
-        stage1_results = self.neck_with_head.get_bboxes(*x, img_metas, rescale=rescale)
-        # img branch
-        if self.with_img_backbone:
-            batch_input_shape = tuple(img[0].size()[-2:])
-            for img_meta in img_metas:
-                img_meta['batch_input_shape'] = batch_input_shape
-            img_features = self.extract_img_feat(img, img_metas)
-            img_dict = dict(
-                img_features=img_features,
-                img_metas=img_metas,
-            )
-        else:
-            img_dict = None
-        stage2_preds = self.stage2_head(select_points, img_dict)
-        stage2_results_all = self.stage2_head.get_bboxes(stage2_preds, select_points[0], img_metas, rescale=rescale)
-
-        bbox_list = []
-        # per image
-        for i in range(len(stage1_results)):
-            results = [stage1_results[i]]
-            for stage2_results in stage2_results_all:
-                results.append(stage2_results[i])
-            ensemble_bboxes, ensemble_scores = [], []
-            for stage in self.test_cfg.ensemble_stages:
-                ensemble_bboxes.append(results[stage][0])
-                ensemble_scores.append(results[stage][1])
-            ensemble_bboxes = torch.cat(ensemble_bboxes, dim=0)
-            ensemble_scores = torch.cat(ensemble_scores, dim=0)
-            nms_process = self.neck_with_head._nms(ensemble_bboxes, ensemble_scores, img_metas[i])
-            bbox_list.append(nms_process)
-        bbox_results = [
-            bbox3d2result(bboxes, scores, labels)
-            for bboxes, scores, labels in bbox_list
-        ]
-        return bbox_results
+    def get_candidates(self, points, img_metas, img=None, rescale=False):
+        """Ensembled boxes and class scores of every sample before NMS."""
+        stages = self.test_cfg.ensemble_stages
+
+        def point_branch():
+            x, select_points = self.extract_feat(points, img_metas)
+            stage1_results = None
+            if 0 in stages:
+                stage1_results = self.neck_with_head.get_bboxes(
+                    *x, img_metas, rescale=rescale)
+            return stage1_results, select_points
+
+        (stage1_results, select_points), img_dict = self.run_branches(
+            point_branch, img, img_metas)
+        # only run the decoder layers and prediction heads that feed the
+        # ensemble, stage 0 is the neck, stage 1 the proposal prediction of
+        # the stage-2 head and stage i > 1 the output of its (i - 1)-th
+        # decoder layer, i.e. stage i > 0 is stage-2 prediction i - 1
+        stage2_preds = self.stage2_head(
+            select_points, img_dict,
+            pred_layers=[stage - 1 for stage in stages if stage > 0])
+        stage2_results_all = self.stage2_head.get_bboxes(
+            stage2_preds, select_points[0], img_metas, rescale=rescale,
+            valid_mask=select_points[3])
+        return self.ensemble_candidates(
+            [stage1_results, *stage2_results_all], stages, len(img_metas))
 
 
 @DETECTORS.register_module()
-class TwoStageSparse3DDetectorFaster(Base3DDetector):
+class TwoStageSparse3DDetectorFaster(CandidateTestMixin, Base3DDetector):
     def __init__(self,
                  backbone,
                  neck_with_head,
@@ -447,6 +684,8 @@ class TwoStageSparse3DDetectorFaster(Base3DDetector):
                  img_encoder=None,
                  freeze_img_branch=False,
                  freeze_stage1=False,
+                 img_feat_cache=None,
+                 voxelize_mode='reference',
                  pretrained=False,
                  train_cfg=None,
                  test_cfg=None):
@@ -456,6 +695,7 @@ class TwoStageSparse3DDetectorFaster(Base3DDetector):
         neck_with_head.update(test_cfg=test_cfg)
         self.neck_with_head = build_head(neck_with_head)
         self.voxel_size = voxel_size
+        self.voxelize_mode = voxelize_mode
         self.train_cfg = train_cfg
         self.test_cfg = test_cfg
 
@@ -468,6 +708,13 @@ class TwoStageSparse3DDetectorFaster(Base3DDetector):
         self.freeze_img_branch = freeze_img_branch
         if freeze_img_branch:
             self.freeze_img_branch_params()
+        self.img_feat_cache = None
+        if img_feat_cache is not None:
+            if freeze_img_branch:
+                self.img_feat_cache = ImgFeatureCache(**img_feat_cache)
+            else:
+                warnings.warn('img_feat_cache is ignored as the image branch '
+                              'is not frozen')
         if freeze_stage1:
             self.freeze_stage1_params()
         if stage2_head is not None:
@@ -490,12 +737,9 @@ class TwoStageSparse3DDetectorFaster(Base3DDetector):
 
     def extract_feat(self, points, img_metas):
         """Extract features from points."""
-        coordinates, features = ME.utils.batch_sparse_collate(
-            [(p[:, :3] / self.voxel_size, p[:, 3:] / 255.) for p in points],
-            device=points[0].device)
-        x = ME.SparseTensor(coordinates=coordinates, features=features)
+        x, _ = batch_voxelize(points, self.voxel_size, self.voxelize_mode)
         x = self.backbone(x)
-        x, select_points = self.neck_with_head(x)
+        x, select_points = self.neck_with_head(x, len(points))
         return x, select_points
 
     def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
@@ -530,9 +774,15 @@ class TwoStageSparse3DDetectorFaster(Base3DDetector):
     @torch.no_grad()
     def extract_img_feat(self, img, img_metas):
         """Directly extract features from the img backbone+neck."""
+        if self.img_feat_cache is not None:
+            x = self.img_feat_cache.get(img_metas, img.device)
+            if x is not None:
+                return x
         x = self.img_backbone(img)
         if self.with_img_neck:
             x = self.img_neck(x)
+        if self.img_feat_cache is not None:
+            self.img_feat_cache.put(img_metas, x)
         return x
 
     def forward_train(self,
@@ -545,7 +795,11 @@ class TwoStageSparse3DDetectorFaster(Base3DDetector):
 
         #
 
-        losses, targets = self.neck_with_head.loss(*x, gt_bboxes_3d, gt_labels_3d, img_metas)
+        # the losses of both stages are normalized with one all-reduce
+        normalizer = DeferredNormalizer()
+        _, targets = self.neck_with_head.loss(
+            *x, gt_bboxes_3d, gt_labels_3d, img_metas, normalizer=normalizer)
+        scene_counts = x[4].sum(dim=1)
         # img branch
         if self.with_img_backbone:
             batch_input_shape = tuple(img[0].size()[-2:])
@@ -559,28 +813,25 @@ class TwoStageSparse3DDetectorFaster(Base3DDetector):
         else:
             img_dict = None
         stage2_preds = self.stage2_head(select_points, img_dict)
-        stage2_targets = self.get_stage2_targets(targets, select_points[-1])
-        stage2_losses = self.stage2_head.loss(stage2_preds, stage2_targets, select_points[0])
-        losses.update(stage2_losses)
-        return losses
-
-    def get_stage2_targets(self, targets, sort_inds):
-        batch_size = len(targets)
-        centerness_targets, bbox_targets, labels = [], [], []
-        for i in range(batch_size):
-            targets_per_img, sort_inds_per_img = targets[i], sort_inds[i]
-            centerness_targets.append(targets_per_img[0][sort_inds_per_img])
-            bbox_targets.append(targets_per_img[1][sort_inds_per_img])
-            labels.append(targets_per_img[2][sort_inds_per_img])
-        centerness_targets = torch.stack(centerness_targets, dim=0)
-        bbox_targets = torch.stack(bbox_targets, dim=0)
-        labels = torch.stack(labels, dim=0)
-        return (centerness_targets, bbox_targets, labels)
-
-    def simple_test(self, points, img_metas, img=None, rescale=False):
-        """Test function without augmentaiton."""
+        stage2_targets = self.get_stage2_targets(
+            targets, select_points[2], scene_counts)
+        self.stage2_head.loss(
+            stage2_preds, stage2_targets, select_points[0], select_points[3],
+            normalizer=normalizer)
+        return normalizer.compute()
+
+    def get_stage2_targets(self, targets, sort_inds, scene_counts):
+        """Targets of the selected proposals with one gather."""
+        rows = sort_inds + (scene_counts.cumsum(0) - scene_counts).unsqueeze(1)
+        return tuple(target[rows] for target in targets)
+
+    def get_candidates(self, points, img_metas, img=None, rescale=False):
+        """Ensembled boxes and class scores of every sample before NMS."""
+        stages = self.test_cfg.ensemble_stages
         x, select_points = self.extract_feat(points, img_metas)
-        stage1_results = self.neck_with_head.get_bboxes(*x, img_metas, rescale=rescale)
+        stage1_results = None
+        if 0 in stages:
+            stage1_results = self.neck_with_head.get_bboxes(*x, img_metas, rescale=rescale)
         # img branch
         if self.with_img_backbone:
             batch_input_shape = tuple(img[0].size()[-2:])
@@ -593,28 +844,15 @@ class TwoStageSparse3DDetectorFaster(Base3DDetector):
             )
         else:
             img_dict = None
-        stage2_preds = self.stage2_head(select_points, img_dict)
-        stage2_results_all = self.stage2_head.get_bboxes(stage2_preds, select_points[0], img_metas, rescale=rescale)
-
-        bbox_list = []
-        # per image
-        for i in range(len(stage1_results)):
-            results = [stage1_results[i]]
-            for stage2_results in stage2_results_all:
-                results.append(stage2_results[i])
-            ensemble_bboxes, ensemble_scores = [], []
-            for stage in self.test_cfg.ensemble_stages:
-                ensemble_bboxes.append(results[stage][0])
-                ensemble_scores.append(results[stage][1])
-            ensemble_bboxes = torch.cat(ensemble_bboxes, dim=0)
-            ensemble_scores = torch.cat(ensemble_scores, dim=0)
-            nms_process = self.neck_with_head._nms(ensemble_bboxes, ensemble_scores, img_metas[i])
-            bbox_list.append(nms_process)
-        bbox_results = [
-            bbox3d2result(bboxes, scores, labels)
-            for bboxes, scores, labels in bbox_list
-        ]
-        return bbox_results
-
-    def aug_test(self, points, img_metas, imgs=None, rescale=False):
-        pass
+        # only run the decoder layers and prediction heads that feed the
+        # ensemble, stage 0 is the neck, stage 1 the proposal prediction of
+        # the stage-2 head and stage i > 1 the output of its (i - 1)-th
+        # decoder layer, i.e. stage i > 0 is stage-2 prediction i - 1
+        stage2_preds = self.stage2_head(
+            select_points, img_dict,
+            pred_layers=[stage - 1 for stage in stages if stage > 0])
+        stage2_results_all = self.stage2_head.get_bboxes(
+            stage2_preds, select_points[0], img_metas, rescale=rescale,
+            valid_mask=select_points[3])
+        return self.ensemble_candidates(
+            [stage1_results, *stage2_results_all], stages, len(img_metas))
@@ -20,11 +20,15 @@ from .tr3d_ff import TR3DFF3DDetector
 from .votenet import VoteNet, VoteNetFF
 from .voxelnet import VoxelNet
 from .single_stage_sparse import SingleStageSparse3DDetector, SingleStageSparse3DDetector_CA
+from .deform_attn import CPUDeformableAttention, LazyValueDeformableAttention
+from .img_encoder import SparseDeformableDetrEncoder
 
 __all__ = [
     'Base3DDetector', 'VoxelNet', 'DynamicVoxelNet', 'MVXTwoStageDetector',
     'DynamicMVXFasterRCNN', 'MVXFasterRCNN', 'PartA2', 'VoteNet', 'H3DNet',
     'CenterPoint', 'SSD3DNet', 'ImVoteNet', 'SingleStageMono3DDetector','SingleStageSparse3DDetector_CA',
     'FCOSMono3D', 'ImVoxelNet', 'GroupFree3DNet', 'PointRCNN', 'SMOKEMono3D',
-    'MinkSingleStage3DDetector', 'SASSD', 'TR3DFF3DDetector', 'VoteNetFF'
+    'MinkSingleStage3DDetector', 'SASSD', 'TR3DFF3DDetector', 'VoteNetFF',
+    'LazyValueDeformableAttention', 'CPUDeformableAttention',
+    'SparseDeformableDetrEncoder'
 ]
@@ -0,0 +1,253 @@
+import torch
+import torch.nn.functional as F
+from mmcv.cnn.bricks.registry import ATTENTION
+
+try:
+    from mmcv.ops.multi_scale_deform_attn import MultiScaleDeformableAttention
+except ImportError:
+    from mmcv.cnn.bricks.transformer import MultiScaleDeformableAttention
+
+
+def get_sampling(attn, query, reference_points, spatial_shapes):
+    """Sampling locations and attention weights of a deformable attention.
+
+    The same as in ``MultiScaleDeformableAttention.forward``.
+
+    Args:
+        attn (MultiScaleDeformableAttention): The attention module.
+        query (torch.Tensor): [BS, N_query, C] queries, with their position
+            embedding added.
+        reference_points (torch.Tensor): [BS, N_query, N_lvl, 2 or 4]
+            normalized reference points or boxes.
+        spatial_shapes (torch.Tensor): [N_lvl, 2] level shapes (h, w).
+
+    Returns:
+        tuple[torch.Tensor]: Sampling locations in [0, 1] with shape
+            [BS, N_query, N_head, N_lvl, N_point, 2] and attention weights
+            with shape [BS, N_query, N_head, N_lvl, N_point].
+    """
+    bs, num_query, _ = query.shape
+    sampling_offsets = attn.sampling_offsets(query).view(
+        bs, num_query, attn.num_heads, attn.num_levels, attn.num_points, 2)
+    attention_weights = attn.attention_weights(query).view(
+        bs, num_query, attn.num_heads, attn.num_levels * attn.num_points)
+    attention_weights = attention_weights.softmax(-1).view(
+        bs, num_query, attn.num_heads, attn.num_levels, attn.num_points)
+    if reference_points.shape[-1] == 2:
+        offset_normalizer = torch.stack(
+            [spatial_shapes[..., 1], spatial_shapes[..., 0]], -1)
+        sampling_locations = reference_points[:, :, None, :, None, :] \
+            + sampling_offsets \
+            / offset_normalizer[None, None, None, :, None, :]
+    elif reference_points.shape[-1] == 4:
+        sampling_locations = reference_points[:, :, None, :, None, :2] \
+            + sampling_offsets / attn.num_points \
+            * reference_points[:, :, None, :, None, 2:] \
+            * 0.5
+    else:
+        raise ValueError(
+            f'Last dim of reference_points must be'
+            f' 2 or 4, but get {reference_points.shape[-1]} instead.')
+    return sampling_locations, attention_weights
+
+
+@ATTENTION.register_module()
+class LazyValueDeformableAttention(MultiScaleDeformableAttention):
+    """Deformable attention projecting the sampled values only.
+
+    ``MultiScaleDeformableAttention`` projects every token of the value
+    through ``value_proj`` before sampling, although only
+    N_query x N_head x N_lvl x N_point locations are read. Bilinear
+    sampling and the attention weighted sum are linear, so this variant
+    samples and sums the raw value first and projects the N_query x N_head
+    results with the per head slices of ``value_proj``. A channel of ones
+    sampled along carries the weight of the projection bias, which is less
+    than one where samples fall outside the image or on padding.
+
+    It has the parameters of ``MultiScaleDeformableAttention`` and is a
+    drop-in ``attn_cfgs`` type, cheaper when the queries are far fewer
+    than the value tokens, like the stage-2 proposals.
+    """
+
+    def forward(self,
+                query,
+                key=None,
+                value=None,
+                identity=None,
+                query_pos=None,
+                key_padding_mask=None,
+                reference_points=None,
+                spatial_shapes=None,
+                level_start_index=None,
+                **kwargs):
+        if value is None:
+            value = query
+        if identity is None:
+            identity = query
+        if query_pos is not None:
+            query = query + query_pos
+        if not self.batch_first:
+            # change to (bs, num_query ,embed_dims)
+            query = query.permute(1, 0, 2)
+            value = value.permute(1, 0, 2)
+
+        bs, num_query, _ = query.shape
+        bs, num_value, channels = value.shape
+        assert (spatial_shapes[:, 0] * spatial_shapes[:, 1]).sum() == num_value
+
+        sampling_locations, attention_weights = get_sampling(
+            self, query, reference_points, spatial_shapes)
+
+        ones = value.new_ones(bs, num_value, 1)
+        if key_padding_mask is not None:
+            value = value.masked_fill(key_padding_mask[..., None], 0.0)
+            ones = ones.masked_fill(key_padding_mask[..., None], 0.0)
+        value = torch.cat((value, ones), dim=-1).transpose(1, 2)
+
+        # all heads sample the shared raw value, stacked along the queries
+        sampling_grids = (2 * sampling_locations - 1).flatten(1, 2)
+        attention_weights = attention_weights.flatten(1, 2)
+        sampled = value.new_zeros(bs, channels + 1, num_query * self.num_heads)
+        start = 0
+        for level, (h, w) in enumerate(spatial_shapes.tolist()):
+            value_l = value[:, :, start:start + h * w].reshape(
+                bs, channels + 1, h, w)
+            start += h * w
+            # bs, C + 1, num_query * num_heads, num_points
+            sampled_l = F.grid_sample(
+                value_l,
+                sampling_grids[:, :, level],
+                mode='bilinear',
+                padding_mode='zeros',
+                align_corners=False)
+            sampled += torch.einsum('bcqp,bqp->bcq', sampled_l,
+                                    attention_weights[:, :, level])
+        sampled = sampled.view(bs, channels + 1, num_query, self.num_heads)
+
+        weight = self.value_proj.weight.view(self.num_heads, -1, channels)
+        bias = self.value_proj.bias.view(self.num_heads, -1)
+        output = torch.einsum('bcqh,hdc->bqhd', sampled[:, :channels], weight)
+        output = output + sampled[:, channels, :, :, None] * bias
+        output = self.output_proj(output.flatten(2))
+
+        if not self.batch_first:
+            # (num_query, bs ,embed_dims)
+            output = output.permute(1, 0, 2)
+
+        return self.dropout(output) + identity
+
+
+def multi_scale_deformable_attn_cpu(value, spatial_shapes, sampling_locations,
+                                    attention_weights):
+    """Multi-scale deformable attention in one pass over all levels.
+
+    A drop-in for ``multi_scale_deformable_attn_pytorch``, which samples
+    every level with ``F.grid_sample`` into a
+    [BS * N_head, C, N_query, N_lvl * N_point] tensor before reducing it.
+    Here the four bilinear corners of every sample, at all levels, are
+    turned into rows of the flattened value and weights folding the
+    bilinear and the attention weights, and ``F.embedding_bag`` gathers and
+    sums them per query and head, so no sampled value is materialized.
+
+    Args:
+        value (torch.Tensor): [BS, N_value, N_head, C] projected value.
+        spatial_shapes (torch.Tensor): [N_lvl, 2] level shapes (h, w).
+        sampling_locations (torch.Tensor): [BS, N_query, N_head, N_lvl,
+            N_point, 2] sampling locations in [0, 1].
+        attention_weights (torch.Tensor): [BS, N_query, N_head, N_lvl,
+            N_point] attention weights.
+
+    Returns:
+        torch.Tensor: [BS, N_query, N_head * C] attended values.
+    """
+    bs, num_value, num_heads, channels = value.shape
+    _, num_query, _, num_levels, num_points, _ = sampling_locations.shape
+    # N_lvl, 1, 1 to broadcast over the points and the corners
+    heights = spatial_shapes[:, 0, None, None]
+    widths = spatial_shapes[:, 1, None, None]
+    level_sizes = spatial_shapes[:, 0] * spatial_shapes[:, 1]
+    level_starts = (level_sizes.cumsum(0) - level_sizes)[:, None, None]
+
+    # pixel coordinates of grid_sample with align_corners=False
+    x = sampling_locations[..., 0] * spatial_shapes[:, None, 1] - 0.5
+    y = sampling_locations[..., 1] * spatial_shapes[:, None, 0] - 0.5
+    x0, y0 = x.floor(), y.floor()
+    dx, dy = x - x0, y - y0
+    x0, y0 = x0.long(), y0.long()
+    # BS, N_query, N_head, N_lvl, N_point, 4 corners
+    xs = torch.stack((x0, x0 + 1, x0, x0 + 1), -1)
+    ys = torch.stack((y0, y0, y0 + 1, y0 + 1), -1)
+    weights = torch.stack(
+        ((1 - dx) * (1 - dy), dx * (1 - dy), (1 - dx) * dy, dx * dy), -1)
+    # corners outside the level are zero padding
+    valid = (xs >= 0) & (xs < widths) & (ys >= 0) & (ys < heights)
+    weights = weights * attention_weights[..., None] * valid
+    index = (level_starts + ys * widths + xs).masked_fill(~valid, 0)
+
+    # rows of the value flattened to BS, N_head, N_value
+    offsets = torch.arange(
+        bs * num_heads, device=value.device).view(bs, 1, num_heads, 1, 1, 1)
+    index = index + offsets * num_value
+    value = value.permute(0, 2, 1, 3).reshape(-1, channels)
+    bag_size = num_levels * num_points * 4
+    output = F.embedding_bag(
+        index.view(-1, bag_size),
+        value,
+        per_sample_weights=weights.view(-1, bag_size),
+        mode='sum')
+    return output.view(bs, num_query, num_heads * channels)
+
+
+@ATTENTION.register_module()
+class CPUDeformableAttention(MultiScaleDeformableAttention):
+    """Deformable attention with a fused kernel for the CPU.
+
+    Without CUDA, ``MultiScaleDeformableAttention`` falls back to
+    ``multi_scale_deformable_attn_pytorch``, which runs ``F.grid_sample``
+    level by level and reduces a large stack of the samples. This variant
+    uses :func:`multi_scale_deformable_attn_cpu` instead. It has the same
+    parameters and is a drop-in ``attn_cfgs`` type for the image encoder
+    and the stage-2 cross attention on CPU deployments.
+    """
+
+    def forward(self,
+                query,
+                key=None,
+                value=None,
+                identity=None,
+                query_pos=None,
+                key_padding_mask=None,
+                reference_points=None,
+                spatial_shapes=None,
+                level_start_index=None,
+                **kwargs):
+        if value is None:
+            value = query
+        if identity is None:
+            identity = query
+        if query_pos is not None:
+            query = query + query_pos
+        if not self.batch_first:
+            # change to (bs, num_query ,embed_dims)
+            query = query.permute(1, 0, 2)
+            value = value.permute(1, 0, 2)
+
+        bs, num_query, _ = query.shape
+        bs, num_value, _ = value.shape
+        assert (spatial_shapes[:, 0] * spatial_shapes[:, 1]).sum() == num_value
+
+        value = self.value_proj(value)
+        if key_padding_mask is not None:
+            value = value.masked_fill(key_padding_mask[..., None], 0.0)
+        value = value.view(bs, num_value, self.num_heads, -1)
+        sampling_locations, attention_weights = get_sampling(
+            self, query, reference_points, spatial_shapes)
+        output = multi_scale_deformable_attn_cpu(
+            value, spatial_shapes, sampling_locations, attention_weights)
+        output = self.output_proj(output)
+
+        if not self.batch_first:
+            # (num_query, bs ,embed_dims)
+            output = output.permute(1, 0, 2)
+
+        return self.dropout(output) + identity
@@ -0,0 +1,292 @@
+import torch
+from torch import nn
+import torch.nn.functional as F
+from mmcv.cnn.bricks.transformer import (build_positional_encoding,
+                                         build_transformer_layer_sequence)
+from mmcv.runner import BaseModule
+from mmdet.models.builder import HEADS
+
+try:
+    from mmcv.ops.multi_scale_deform_attn import MultiScaleDeformableAttention
+except ImportError:
+    from mmcv.cnn.bricks.transformer import MultiScaleDeformableAttention
+
+
+@HEADS.register_module()
+class SparseDeformableDetrEncoder(BaseModule):
+    """Deformable DETR encoder of the image features, optionally sparse.
+
+    The dense mode encodes every token of all levels, like
+    ``DeformableDetrEncoder``, whose ``encoder`` and ``level_embeds``
+    parameters it shares. The stage-2 head only reads the image features
+    around the projections of its proposals, so in the sparse mode only the
+    tokens within ``radius`` cells of a projected proposal, at every level,
+    are encoded. They still attend to all the tokens, and the others are
+    left as the un-encoded neck output.
+
+    Args:
+        encoder (dict): Config of the ``DetrTransformerEncoder``.
+        positional_encoding (dict): Config of the positional encoding.
+        num_feature_levels (int): Number of feature levels. Default: 4.
+        embed_dims (int): Feature channels. Default: 256.
+        sparse (bool): Whether to encode the proposal neighborhoods only.
+            Default: False.
+        radius (int | list[int]): Half size in cells of the square
+            neighborhood kept around every proposal, or one per level.
+            Default: 2.
+    """
+
+    def __init__(self,
+                 encoder,
+                 positional_encoding,
+                 num_feature_levels=4,
+                 embed_dims=256,
+                 sparse=False,
+                 radius=2,
+                 init_cfg=None):
+        super().__init__(init_cfg=init_cfg)
+        self.encoder = build_transformer_layer_sequence(encoder)
+        self.positional_encoding = build_positional_encoding(
+            positional_encoding)
+        self.num_feature_levels = num_feature_levels
+        self.embed_dims = embed_dims
+        self.level_embeds = nn.Parameter(
+            torch.Tensor(num_feature_levels, embed_dims))
+        self.sparse = sparse
+        if isinstance(radius, int):
+            radius = [radius] * num_feature_levels
+        assert len(radius) == num_feature_levels
+        self.radius = radius
+
+    def init_weights(self):
+        for p in self.parameters():
+            if p.dim() > 1:
+                nn.init.xavier_uniform_(p)
+        for m in self.modules():
+            if isinstance(m, MultiScaleDeformableAttention):
+                m.init_weights()
+        nn.init.normal_(self.level_embeds)
+
+    @staticmethod
+    def get_reference_points(spatial_shapes, valid_ratios, device):
+        """Centers of all the tokens, normalized by the valid image area."""
+        reference_points_list = []
+        for lvl, (H, W) in enumerate(spatial_shapes):
+            ref_y, ref_x = torch.meshgrid(
+                torch.linspace(
+                    0.5, H - 0.5, H, dtype=torch.float32, device=device),
+                torch.linspace(
+                    0.5, W - 0.5, W, dtype=torch.float32, device=device))
+            ref_y = ref_y.reshape(-1)[None] / (
+                valid_ratios[:, None, lvl, 1] * H)
+            ref_x = ref_x.reshape(-1)[None] / (
+                valid_ratios[:, None, lvl, 0] * W)
+            ref = torch.stack((ref_x, ref_y), -1)
+            reference_points_list.append(ref)
+        reference_points = torch.cat(reference_points_list, 1)
+        reference_points = reference_points[:, :, None] * valid_ratios[:, None]
+        return reference_points
+
+    @staticmethod
+    def get_valid_ratio(mask):
+        """Get the valid radios of feature maps of all  level."""
+        _, H, W = mask.shape
+        valid_H = torch.sum(~mask[:, :, 0], 1)
+        valid_W = torch.sum(~mask[:, 0, :], 1)
+        valid_ratio_h = valid_H.float() / H
+        valid_ratio_w = valid_W.float() / W
+        valid_ratio = torch.stack([valid_ratio_w, valid_ratio_h], -1)
+        return valid_ratio
+
+    def get_token_mask(self, proposal_uvs, spatial_shapes, valid_ratios):
+        """Tokens within the neighborhood of a proposal at every level.
+
+        Args:
+            proposal_uvs (torch.Tensor): [BS, N, 2] image coordinates of the
+                proposals, normalized by the image size.
+            spatial_shapes (list[tuple[int]]): (h, w) of every level.
+            valid_ratios (torch.Tensor): [BS, N_lvl, 2] valid ratios.
+
+        Returns:
+            torch.Tensor: [BS, N_value] mask of the tokens to encode.
+        """
+        bs = len(proposal_uvs)
+        masks = []
+        for lvl, (h, w) in enumerate(spatial_shapes):
+            r = self.radius[lvl]
+            # proposal cells at this level
+            size = valid_ratios.new_tensor([w, h]) * valid_ratios[:, lvl]
+            cells = (proposal_uvs * size[:, None]).long()
+            offsets = torch.arange(-r, r + 1, device=cells.device)
+            xs = (cells[..., 0, None] + offsets).clamp(0, w - 1)
+            ys = (cells[..., 1, None] + offsets).clamp(0, h - 1)
+            # BS, N, 2r + 1, 2r + 1
+            indices = ys[..., :, None] * w + xs[..., None, :]
+            mask = proposal_uvs.new_zeros(bs, h * w, dtype=torch.bool)
+            mask.scatter_(1, indices.flatten(1), True)
+            masks.append(mask)
+        return torch.cat(masks, 1)
+
+    def run_sparse(self, query, query_pos, reference_points, token_mask,
+                   **kwargs):
+        """Encode the masked tokens, attending to all the current tokens.
+
+        The retained tokens of every image are padded to the largest count
+        of the batch, the padding is run but not written back.
+        """
+        bs, num_value, _ = query.shape
+        counts = token_mask.sum(1)
+        num_retained = int(counts.max())
+        # retained tokens first
+        rows = token_mask.float().argsort(dim=1, descending=True)
+        rows = rows[:, :num_retained]
+        valid = torch.arange(
+            num_retained, device=rows.device)[None] < counts[:, None]
+        batch_ids = torch.arange(bs, device=rows.device)[:, None].expand_as(
+            rows)
+        tokens = query[batch_ids, rows]
+        tokens_pos = query_pos[batch_ids, rows]
+        tokens_ref = reference_points[batch_ids, rows]
+        value = query
+        post_norm = getattr(self.encoder, 'post_norm', None)
+        for i, layer in enumerate(self.encoder.layers):
+            tokens = self.sparse_layer(layer, tokens, value, tokens_pos,
+                                       tokens_ref, **kwargs)
+            if post_norm is not None and i == len(self.encoder.layers) - 1:
+                tokens = post_norm(tokens)
+            value = value.index_put(
+                (batch_ids[valid], rows[valid]), tokens[valid])
+        return value
+
+    @staticmethod
+    def sparse_layer(layer, query, value, query_pos, reference_points,
+                     key_padding_mask=None, **kwargs):
+        """``BaseTransformerLayer.forward`` with a value other than the
+        queries in its self attention, all [BS, N, C]."""
+        norm_index, attn_index, ffn_index = 0, 0, 0
+        identity = query
+        for op in layer.operation_order:
+            if op == 'self_attn':
+                attn = layer.attentions[attn_index]
+                if not attn.batch_first:
+                    out = attn(
+                        query.transpose(0, 1),
+                        value=value.transpose(0, 1),
+                        identity=identity.transpose(0, 1)
+                        if layer.pre_norm else None,
+                        query_pos=query_pos.transpose(0, 1),
+                        key_padding_mask=key_padding_mask,
+                        reference_points=reference_points,
+                        **kwargs).transpose(0, 1)
+                else:
+                    out = attn(
+                        query,
+                        value=value,
+                        identity=identity if layer.pre_norm else None,
+                        query_pos=query_pos,
+                        key_padding_mask=key_padding_mask,
+                        reference_points=reference_points,
+                        **kwargs)
+                query = out
+                attn_index += 1
+                identity = query
+            elif op == 'norm':
+                query = layer.norms[norm_index](query)
+                norm_index += 1
+            elif op == 'ffn':
+                query = layer.ffns[ffn_index](
+                    query, identity if layer.pre_norm else None)
+                ffn_index += 1
+            else:
+                raise ValueError(f'{op} is not supported in the sparse mode')
+        return query
+
+    def forward(self, mlvl_feats, img_metas, proposal_uvs=None):
+        """Encode the image features.
+
+        Args:
+            mlvl_feats (tuple[torch.Tensor]): [BS, C, H, W] features.
+            img_metas (list[dict]): Meta information of the images.
+            proposal_uvs (torch.Tensor, optional): [BS, N, 2] normalized
+                image coordinates of the proposals, required by the sparse
+                mode.
+
+        Returns:
+            list[torch.Tensor]: Encoded [BS, C, H, W] features.
+        """
+        batch_size = mlvl_feats[0].size(0)
+        input_img_h, input_img_w = img_metas[0]['batch_input_shape']
+        img_masks = mlvl_feats[0].new_ones(
+            (batch_size, input_img_h, input_img_w))
+        for img_id in range(batch_size):
+            img_h, img_w, _ = img_metas[img_id]['img_shape']
+            img_masks[img_id, :img_h, :img_w] = 0
+
+        mlvl_masks = []
+        mlvl_positional_encodings = []
+        for feat in mlvl_feats:
+            mlvl_masks.append(
+                F.interpolate(img_masks[None],
+                              size=feat.shape[-2:]).to(torch.bool).squeeze(0))
+            mlvl_positional_encodings.append(
+                self.positional_encoding(mlvl_masks[-1]))
+
+        feat_flatten = []
+        mask_flatten = []
+        lvl_pos_embed_flatten = []
+        spatial_shapes = []
+        for lvl, (feat, mask, pos_embed) in enumerate(
+                zip(mlvl_feats, mlvl_masks, mlvl_positional_encodings)):
+            bs, c, h, w = feat.shape
+            spatial_shapes.append((h, w))
+            feat_flatten.append(feat.flatten(2).transpose(1, 2))
+            mask_flatten.append(mask.flatten(1))
+            lvl_pos_embed_flatten.append(
+                pos_embed.flatten(2).transpose(1, 2) +
+                self.level_embeds[lvl].view(1, 1, -1))
+        # BS, N_value, C
+        feat_flatten = torch.cat(feat_flatten, 1)
+        mask_flatten = torch.cat(mask_flatten, 1)
+        lvl_pos_embed_flatten = torch.cat(lvl_pos_embed_flatten, 1)
+        spatial_shapes_tensor = torch.as_tensor(
+            spatial_shapes, dtype=torch.long, device=feat_flatten.device)
+        level_start_index = torch.cat((spatial_shapes_tensor.new_zeros(
+            (1, )), spatial_shapes_tensor.prod(1).cumsum(0)[:-1]))
+        valid_ratios = torch.stack(
+            [self.get_valid_ratio(m) for m in mlvl_masks], 1)
+        reference_points = self.get_reference_points(
+            spatial_shapes, valid_ratios, device=feat.device)
+
+        if self.sparse:
+            assert proposal_uvs is not None, \
+                'the sparse mode encodes around the proposals'
+            token_mask = self.get_token_mask(
+                proposal_uvs, spatial_shapes, valid_ratios) & ~mask_flatten
+            memory = self.run_sparse(
+                feat_flatten,
+                lvl_pos_embed_flatten,
+                reference_points,
+                token_mask,
+                key_padding_mask=mask_flatten,
+                spatial_shapes=spatial_shapes_tensor,
+                level_start_index=level_start_index,
+                valid_ratios=valid_ratios)
+        else:
+            memory = self.encoder(
+                query=feat_flatten.transpose(0, 1),
+                key=None,
+                value=None,
+                query_pos=lvl_pos_embed_flatten.transpose(0, 1),
+                query_key_padding_mask=mask_flatten,
+                spatial_shapes=spatial_shapes_tensor,
+                reference_points=reference_points,
+                level_start_index=level_start_index,
+                valid_ratios=valid_ratios).transpose(0, 1)
+
+        # back to the levels, BS, C, H, W
+        return [
+            level.transpose(1, 2).reshape(batch_size, -1, h, w)
+            for level, (h, w) in zip(
+                memory.split([h * w for h, w in spatial_shapes], 1),
+                spatial_shapes)
+        ]
@@ -5,6 +5,9 @@ import torch.nn as nn
 from mmcv.cnn.bricks.registry import TRANSFORMER_LAYER
 from mmcv.cnn.bricks.transformer import build_transformer_layer
 
+# registers the deformable attention variants of the decoder attn_cfgs
+from mmdet3d.models.fusion_layers import deform_attn  # noqa: F401
+
 try:
     from mmcv.ops.multi_scale_deform_attn import MultiScaleDeformableAttention
 
@@ -30,6 +33,19 @@ class PositionEmbeddingLearned(nn.Module):
             nn.ReLU(inplace=True),
             nn.Conv1d(num_pos_feats, num_pos_feats, kernel_size=1))
 
+    @torch.no_grad()
+    def deploy(self):
+        """Fold the eval-mode BatchNorm into the first conv."""
+        conv, bn = self.position_embedding_head[:2]
+        if not isinstance(bn, nn.BatchNorm1d):
+            return
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        bias = conv.bias if conv.bias is not None else \
+            torch.zeros_like(bn.running_mean)
+        conv.weight.mul_(scale[:, None, None])
+        conv.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias)
+        self.position_embedding_head[1] = nn.Identity()
+
     def forward(self, xyz):
         xyz = xyz.transpose(1, 2).contiguous()
         position_embedding = self.position_embedding_head(xyz)
@@ -38,9 +54,13 @@ class PositionEmbeddingLearned(nn.Module):
 
 @TRANSFORMER_LAYER.register_module()
 class TransformerDecoderLayerWithPos(nn.Module):
-    def __init__(self, *args, transformerlayers=None, posembed=None, **kwargs):
+    def __init__(self, *args, transformerlayers=None, posembed=None,
+                 batch_first=False, **kwargs):
         super().__init__()
-        self.layer = build_transformer_layer(transformerlayers)
+        # queries and values are [BS, N, C] instead of [N, BS, C]
+        self.batch_first = batch_first
+        self.layer = build_transformer_layer(
+            dict(transformerlayers, batch_first=batch_first))
         self.posembed = PositionEmbeddingLearned(posembed)
 
     def init_weights(self):
@@ -68,7 +88,10 @@ class TransformerDecoderLayerWithPos(nn.Module):
                 valid_ratios[:, None]
 
         query_pos_embed = self.posembed(query_pos)
-        query_pos_embed = query_pos_embed.permute(2, 0, 1)
+        if self.batch_first:
+            query_pos_embed = query_pos_embed.transpose(1, 2)
+        else:
+            query_pos_embed = query_pos_embed.permute(2, 0, 1)
 
         output = self.layer(
             query,
@@ -82,9 +105,13 @@ class TransformerDecoderLayerWithPos(nn.Module):
 
 @TRANSFORMER_LAYER.register_module()
 class TransformerDecoderLayerWithoutPos(nn.Module):
-    def __init__(self, *args, transformerlayers=None, **kwargs):
+    def __init__(self, *args, transformerlayers=None, batch_first=False,
+                 **kwargs):
         super().__init__()
-        self.layer = build_transformer_layer(transformerlayers)
+        # queries and values are [BS, N, C] instead of [N, BS, C]
+        self.batch_first = batch_first
+        self.layer = build_transformer_layer(
+            dict(transformerlayers, batch_first=batch_first))
 
     def init_weights(self):
         """Initialize the weights."""
@@ -0,0 +1,370 @@
+import torch
+
+try:
+    from mmdet3d.ops.pcdet_nms import pcdet_nms_gpu, pcdet_nms_normal_gpu
+except ImportError:
+    pcdet_nms_gpu = pcdet_nms_normal_gpu = None
+
+# in-box tolerance and union epsilon of the pcdet iou3d_nms kernels
+MARGIN = 1e-2
+EPS = 1e-8
+
+
+def _cross(a, b):
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+
+def bev_corners(boxes):
+    """Counter-clockwise BEV corners of boxes.
+
+    Args:
+        boxes (torch.Tensor): Boxes (x, y, z, dx, dy, dz, yaw) with
+            shape (N, 7).
+
+    Returns:
+        torch.Tensor: Corners with shape (N, 4, 2).
+    """
+    signs = boxes.new_tensor([[-.5, -.5], [.5, -.5], [.5, .5], [-.5, .5]])
+    local = signs * boxes[:, None, 3:5]
+    cos = boxes[:, 6].cos()[:, None]
+    sin = boxes[:, 6].sin()[:, None]
+    x = local[..., 0] * cos - local[..., 1] * sin + boxes[:, None, 0]
+    y = local[..., 0] * sin + local[..., 1] * cos + boxes[:, None, 1]
+    return torch.stack((x, y), dim=-1)
+
+
+def _in_box(points, boxes):
+    """Whether points (P, K, 2) lie in their boxes (P, 7), with margin."""
+    dx = points[..., 0] - boxes[:, None, 0]
+    dy = points[..., 1] - boxes[:, None, 1]
+    cos = boxes[:, 6].cos()[:, None]
+    sin = boxes[:, 6].sin()[:, None]
+    local_x = dx * cos + dy * sin
+    local_y = dy * cos - dx * sin
+    return (local_x.abs() < boxes[:, None, 3] / 2 + MARGIN) & \
+        (local_y.abs() < boxes[:, None, 4] / 2 + MARGIN)
+
+
+def _rotated_bev_overlaps(boxes_a, boxes_b):
+    """Intersection areas of paired rotated BEV boxes.
+
+    The intersection polygon is built from the corners of each box inside
+    the other one and the crossings of their edges, sorted by angle around
+    its center and measured with the shoelace formula, like the pcdet
+    ``box_overlap`` kernel but for all pairs at once.
+    """
+    corners_a = bev_corners(boxes_a)
+    corners_b = bev_corners(boxes_b)
+    a0, b0 = corners_a, corners_b
+    da = (corners_a.roll(-1, dims=1) - a0)[:, :, None]
+    db = (corners_b.roll(-1, dims=1) - b0)[:, None]
+    ab = b0[:, None] - a0[:, :, None]
+    denom = _cross(da, db)
+    parallel = denom.abs() < EPS
+    denom = torch.where(parallel, torch.ones_like(denom), denom)
+    t = _cross(ab, db) / denom
+    u = _cross(ab, da) / denom
+    cross_mask = ~parallel & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    cross_points = a0[:, :, None] + t[..., None] * da
+
+    points = torch.cat(
+        (corners_a, corners_b, cross_points.flatten(1, 2)), dim=1)
+    mask = torch.cat((_in_box(corners_a, boxes_b), _in_box(
+        corners_b, boxes_a), cross_mask.flatten(1)), dim=1)
+
+    n_points = mask.sum(1)
+    center = (points * mask[..., None]).sum(1) / \
+        n_points.clamp(min=1)[:, None].to(points.dtype)
+    offsets = points - center[:, None]
+    angles = torch.atan2(offsets[..., 1], offsets[..., 0])
+    # invalid points go last and collapse onto the first one, so their
+    # edges have no area
+    angles = torch.where(mask, angles, angles.new_full((), 10.))
+    angles, order = angles.sort(dim=1)
+    offsets = offsets.gather(1, order[..., None].expand(-1, -1, 2))
+    mask = mask.gather(1, order)
+    offsets = torch.where(mask[..., None], offsets, offsets[:, :1])
+    areas = _cross(offsets, offsets.roll(-1, dims=1)).sum(1).abs() / 2
+    return torch.where(n_points > 2, areas, areas.new_zeros(()))
+
+
+def _aligned_bev_overlaps(boxes_a, boxes_b):
+    """Intersection areas of paired BEV boxes, ignoring their yaw."""
+    left_top = torch.max(boxes_a[:, :2] - boxes_a[:, 3:5] / 2,
+                         boxes_b[:, :2] - boxes_b[:, 3:5] / 2)
+    right_bottom = torch.min(boxes_a[:, :2] + boxes_a[:, 3:5] / 2,
+                             boxes_b[:, :2] + boxes_b[:, 3:5] / 2)
+    sizes = (right_bottom - left_top).clamp(min=0)
+    return sizes[:, 0] * sizes[:, 1]
+
+
+def paired_bev_iou(boxes_a, boxes_b, with_yaw=True):
+    """BEV IoU of paired boxes, as computed by the pcdet NMS kernels.
+
+    Args:
+        boxes_a (torch.Tensor): Boxes (x, y, z, dx, dy, dz, yaw) with
+            shape (P, 7).
+        boxes_b (torch.Tensor): Boxes paired with ``boxes_a``, (P, 7).
+        with_yaw (bool, optional): Rotated IoU like ``pcdet_nms_gpu`` or
+            axis-aligned IoU like ``pcdet_nms_normal_gpu``. Default: True.
+
+    Returns:
+        torch.Tensor: IoU of every pair with shape (P, ).
+    """
+    if with_yaw:
+        overlaps = _rotated_bev_overlaps(boxes_a, boxes_b)
+    else:
+        overlaps = _aligned_bev_overlaps(boxes_a, boxes_b)
+    areas_a = boxes_a[:, 3] * boxes_a[:, 4]
+    areas_b = boxes_b[:, 3] * boxes_b[:, 4]
+    return overlaps / (areas_a + areas_b - overlaps).clamp(min=EPS)
+
+
+def dense_candidate_pairs(boxes, groups=None, chunk_size=1024):
+    """Pairs i < j of boxes whose circumscribed BEV circles intersect.
+
+    Args:
+        boxes (torch.Tensor): Boxes with shape (N, 7).
+        groups (torch.Tensor, optional): Group of every box, only boxes of
+            the same group are paired. Default: None.
+        chunk_size (int, optional): Rows compared at once. Default: 1024.
+
+    Returns:
+        tuple[torch.Tensor]: Indices i and j of the pairs.
+    """
+    n_boxes = len(boxes)
+    centers = boxes[:, :2]
+    radii = boxes[:, 3:5].norm(dim=1) / 2 + 2 * MARGIN
+    ids = torch.arange(n_boxes, device=boxes.device)
+    sources, targets = [ids.new_zeros(0)], [ids.new_zeros(0)]
+    for start in range(0, n_boxes, chunk_size):
+        end = min(start + chunk_size, n_boxes)
+        distances = (centers[start:end, None] - centers[None]).norm(dim=-1)
+        near = (distances < radii[start:end, None] + radii[None]) & \
+            (ids[None] > ids[start:end, None])
+        if groups is not None:
+            near &= groups[start:end, None] == groups[None]
+        source, target = near.nonzero(as_tuple=True)
+        sources.append(source + start)
+        targets.append(target)
+    return torch.cat(sources), torch.cat(targets)
+
+
+def bucketed_candidate_pairs(boxes, groups=None):
+    """Pairs i < j of boxes whose circumscribed BEV circles intersect.
+
+    Box centers are bucketed into a BEV grid with cells as wide as the
+    largest circle diameter, so overlapping boxes always lie in the same
+    or in neighboring cells and only those are compared. The cost grows
+    with the number of close pairs instead of the squared number of boxes.
+    The grid is 2D since the BEV IoU ignores z.
+
+    Args:
+        boxes (torch.Tensor): Boxes with shape (N, 7).
+        groups (torch.Tensor, optional): Group of every box, only boxes of
+            the same group are paired. Default: None.
+
+    Returns:
+        tuple[torch.Tensor]: Indices i and j of the pairs.
+    """
+    n_boxes = len(boxes)
+    if n_boxes == 0:
+        empty = torch.zeros(0, dtype=torch.long, device=boxes.device)
+        return empty, empty
+    centers = boxes[:, :2]
+    radii = boxes[:, 3:5].norm(dim=1) / 2 + 2 * MARGIN
+    cell_size = 2 * radii.max()
+    # one empty cell of padding on each side keeps neighbors in range
+    cells = ((centers - centers.min(0)[0]) / cell_size).long() + 1
+    n_x, n_y = (cells.max(0)[0] + 2).tolist()
+    if groups is None:
+        groups = torch.zeros_like(cells[:, 0])
+    keys = (groups * n_x + cells[:, 0]) * n_y + cells[:, 1]
+    sorted_keys, order = keys.sort()
+
+    sources, targets = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbor_keys = keys + dx * n_y + dy
+            starts = torch.searchsorted(sorted_keys, neighbor_keys)
+            ends = torch.searchsorted(sorted_keys, neighbor_keys, right=True)
+            counts = ends - starts
+            source = torch.repeat_interleave(
+                torch.arange(n_boxes, device=boxes.device), counts)
+            # position of every target inside its neighbor cell
+            first = torch.repeat_interleave(counts.cumsum(0) - counts, counts)
+            position = torch.arange(len(source), device=boxes.device) - first
+            target = order[torch.repeat_interleave(starts, counts) + position]
+            mask = target > source
+            sources.append(source[mask])
+            targets.append(target[mask])
+    sources, targets = torch.cat(sources), torch.cat(targets)
+    distances = (centers[sources] - centers[targets]).norm(dim=-1)
+    near = distances < radii[sources] + radii[targets]
+    return sources[near], targets[near]
+
+
+def greedy_keep(n_boxes, sources, targets):
+    """Resolve greedy NMS from its suppression edges.
+
+    Box j is kept iff no kept box i < j suppresses it. Instead of visiting
+    the boxes one by one, all boxes are updated at once until nothing
+    changes. Boxes without a suppressing edge are correct from the start
+    and every sweep fixes the next link of the suppression chains, so this
+    ends after (longest chain + 1) sweeps on the unique greedy solution.
+
+    Args:
+        n_boxes (int): Number of boxes, sorted by decreasing score.
+        sources (torch.Tensor): Suppressing box of every edge.
+        targets (torch.Tensor): Suppressed box of every edge, > source.
+
+    Returns:
+        torch.Tensor: Boolean keep mask with shape (n_boxes, ).
+    """
+    keep = torch.ones(n_boxes, dtype=torch.bool, device=sources.device)
+    while True:
+        suppressed = torch.zeros_like(keep)
+        suppressed[targets[keep[sources]]] = True
+        if torch.equal(~suppressed, keep):
+            return keep
+        keep = ~suppressed
+
+
+def nms_bev(boxes,
+            scores,
+            iou_thr,
+            with_yaw=True,
+            groups=None,
+            candidate_pairs=dense_candidate_pairs,
+            pair_chunk_size=65536):
+    """Vectorized greedy BEV NMS with the keep set of the pcdet kernels.
+
+    Only uses torch operations, so it runs on any device.
+
+    Args:
+        boxes (torch.Tensor): Boxes (x, y, z, dx, dy, dz, yaw) with
+            shape (N, 7).
+        scores (torch.Tensor): Scores with shape (N, ).
+        iou_thr (float): A box is suppressed by a kept box of higher score
+            if their BEV IoU is above this threshold.
+        with_yaw (bool, optional): Rotated or axis-aligned IoU.
+            Default: True.
+        groups (torch.Tensor, optional): Group of every box, boxes only
+            suppress boxes of their group. Default: None.
+        candidate_pairs (callable, optional): Returns the pairs i < j of
+            score sorted boxes of a group that may overlap.
+            Default: :func:`dense_candidate_pairs`.
+        pair_chunk_size (int, optional): Pairs sent to the IoU at once.
+            Default: 65536.
+
+    Returns:
+        torch.Tensor: Indices of the kept boxes by decreasing score.
+    """
+    order = scores.sort(descending=True)[1]
+    boxes = boxes[order].double()
+    if groups is not None:
+        groups = groups[order]
+    sources, targets = candidate_pairs(boxes, groups)
+    over = []
+    for start in range(0, len(sources), pair_chunk_size):
+        source = sources[start:start + pair_chunk_size]
+        target = targets[start:start + pair_chunk_size]
+        over.append(
+            paired_bev_iou(boxes[source], boxes[target], with_yaw) > iou_thr)
+    over = torch.cat(over) if len(over) else sources.new_zeros(
+        0, dtype=torch.bool)
+    keep = greedy_keep(len(boxes), sources[over], targets[over])
+    return order[keep]
+
+
+def _resolve_backend(backend, boxes):
+    if backend == 'auto':
+        backend = 'gpu' if boxes.is_cuda and pcdet_nms_gpu is not None \
+            else 'cpu'
+    if backend == 'gpu' and pcdet_nms_gpu is None:
+        raise ImportError('pcdet NMS ops are not built, '
+                          'use nms_backend=\'cpu\'')
+    if backend not in ('gpu', 'cpu', 'bucketed'):
+        raise ValueError(f'Unsupported NMS backend {backend}')
+    return backend
+
+
+def _torch_nms(boxes, scores, iou_thr, with_yaw, groups, backend):
+    """The 'cpu' and 'bucketed' backends."""
+    if backend == 'cpu':
+        keep = nms_bev(boxes.detach().cpu(), scores.detach().cpu(), iou_thr,
+                       with_yaw,
+                       groups.cpu() if groups is not None else None)
+        return keep.to(boxes.device)
+    # bucketed NMS runs on the device of the boxes
+    return nms_bev(
+        boxes.detach(),
+        scores.detach(),
+        iou_thr,
+        with_yaw,
+        groups,
+        candidate_pairs=bucketed_candidate_pairs)
+
+
+def nms_3d(boxes, scores, iou_thr, with_yaw=True, backend='auto'):
+    """BEV NMS of 3D boxes with a selectable backend.
+
+    Args:
+        boxes (torch.Tensor): Boxes (x, y, z, dx, dy, dz, yaw) with
+            shape (N, 7), the yaw is ignored if ``with_yaw`` is False.
+        scores (torch.Tensor): Scores with shape (N, ).
+        iou_thr (float): IoU threshold.
+        with_yaw (bool, optional): Rotated or axis-aligned IoU.
+            Default: True.
+        backend (str, optional): 'gpu' for the pcdet CUDA kernels, 'cpu'
+            for :func:`nms_bev` on CPU with all pairs of boxes,
+            'bucketed' for :func:`nms_bev` on the device of the boxes
+            with grid bucketed pairs, or 'auto' to use the kernels for
+            CUDA tensors when they are built and 'cpu' otherwise. All
+            backends keep the same boxes. Default: 'auto'.
+
+    Returns:
+        torch.Tensor: Indices of the kept boxes by decreasing score.
+    """
+    backend = _resolve_backend(backend, boxes)
+    if backend == 'gpu':
+        nms_function = pcdet_nms_gpu if with_yaw else pcdet_nms_normal_gpu
+        return nms_function(boxes, scores, iou_thr)[0]
+    return _torch_nms(boxes, scores, iou_thr, with_yaw, None, backend)
+
+
+def batched_nms_3d(boxes,
+                   scores,
+                   groups,
+                   iou_thr,
+                   with_yaw=True,
+                   backend='auto'):
+    """BEV NMS run independently on every group of boxes, in one call.
+
+    The torch backends only pair boxes of the same group. For the pcdet
+    kernels the groups are moved apart along x so that boxes of different
+    groups never overlap.
+
+    Args:
+        boxes (torch.Tensor): Boxes with shape (N, 7).
+        scores (torch.Tensor): Scores with shape (N, ).
+        groups (torch.Tensor): Group of every box, e.g. combining the
+            sample and the class, with shape (N, ).
+        iou_thr (float): IoU threshold.
+        with_yaw (bool, optional): Rotated or axis-aligned IoU.
+            Default: True.
+        backend (str, optional): See :func:`nms_3d`. Default: 'auto'.
+
+    Returns:
+        torch.Tensor: Indices of the kept boxes by decreasing score.
+    """
+    if len(boxes) == 0:
+        return groups.new_zeros(0)
+    backend = _resolve_backend(backend, boxes)
+    if backend == 'gpu':
+        span = boxes[:, 0].max() - boxes[:, 0].min() + \
+            boxes[:, 3:5].norm(dim=1).max() + 1
+        boxes = boxes.clone()
+        boxes[:, 0] += groups.to(boxes.dtype) * span
+        return nms_3d(boxes, scores, iou_thr, with_yaw, backend)
+    return _torch_nms(boxes, scores, iou_thr, with_yaw, groups, backend)
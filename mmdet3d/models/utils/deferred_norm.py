@@ -0,0 +1,53 @@
+import torch
+from mmdet.core import reduce_mean
+
+
+class DeferredNormalizer:
+    """Normalize losses of several heads with a single all-reduce.
+
+    Heads register the per scene normalizers of their losses, e.g. the
+    number of positives, computed on this rank only, and add the per scene
+    unnormalized sums of their losses. :meth:`compute` averages all the
+    normalizers over the ranks with one ``reduce_mean`` and returns every
+    loss as the mean over scenes of its sum divided by its normalizer, the
+    same as normalizing every scene with its own ``reduce_mean``.
+
+    Example:
+        >>> normalizer = DeferredNormalizer()
+        >>> n_pos = normalizer.register(n_pos_per_scene, min_value=1.)
+        >>> normalizer.add('loss_cls', cls_loss_per_scene, n_pos)
+        >>> losses = normalizer.compute()
+    """
+
+    def __init__(self):
+        self.normalizers = []
+        self.losses = []
+
+    def register(self, normalizer, min_value):
+        """Register local normalizers of shape (B,), returns their handle.
+
+        After the reduction they are clamped to ``min_value``.
+        """
+        self.normalizers.append((normalizer.detach().float(), min_value))
+        return len(self.normalizers) - 1
+
+    def add(self, name, loss, handle):
+        """Add a loss of shape (B,) summed per scene, normalized later."""
+        self.losses.append((name, loss, handle))
+
+    def compute(self):
+        """Reduce the normalizers once and return the dict of losses."""
+        if not self.normalizers:
+            return dict()
+        sizes = [len(normalizer) for normalizer, _ in self.normalizers]
+        reduced = reduce_mean(
+            torch.cat([normalizer for normalizer, _ in self.normalizers]))
+        normalizers = [
+            normalizer.clamp(min=min_value) for normalizer, (_, min_value) in
+            zip(reduced.split(sizes), self.normalizers)
+        ]
+        losses = dict()
+        for name, loss, handle in self.losses:
+            losses[name] = (loss / normalizers[handle]).mean()
+        self.normalizers, self.losses = [], []
+        return losses
@@ -0,0 +1,18 @@
+def deploy_model(model):
+    """Convert a model to its inference-only form, in place.
+
+    The model is put in eval mode and every submodule with a ``deploy``
+    method converts itself, e.g. folding BatchNorm statistics into convs or
+    switching to fused kernels. The converted model can not be trained.
+
+    Args:
+        model (nn.Module): Model with its weights loaded.
+
+    Returns:
+        nn.Module: The converted model.
+    """
+    model.eval()
+    for module in list(model.modules()):
+        if module is not model and callable(getattr(module, 'deploy', None)):
+            module.deploy()
+    return model
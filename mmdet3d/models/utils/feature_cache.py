@@ -0,0 +1,141 @@
+import hashlib
+import os
+import os.path as osp
+import shutil
+from collections import OrderedDict
+
+import mmcv
+import numpy as np
+import torch
+
+# image meta keys whose values change the output of the image branch
+IMG_PIPELINE_KEYS = ('filename', 'ori_shape', 'img_shape', 'pad_shape',
+                     'batch_input_shape', 'scale_factor', 'flip',
+                     'flip_direction', 'img_norm_cfg')
+
+
+class ImgFeatureCache:
+    """Persistent LRU cache of frozen multi-level image features.
+
+    Features of every sample are stored as one fp16 ``.npy`` file per level
+    in a directory named after the sample index and a hash of the image
+    pipeline results, and are memory-mapped back on hit. Entries are
+    evicted least recently used first once ``max_bytes`` is exceeded.
+
+    The cached features are only valid while the image branch is frozen;
+    random image augmentation changes the pipeline hash and simply misses.
+
+    Args:
+        cache_dir (str): Directory of the cache, shared between runs.
+        max_bytes (int, optional): Byte budget of the cache.
+            Default: 32 GiB.
+        tag (str, optional): Extra string mixed into the keys, e.g. the
+            name of the image branch checkpoint. Default: ''.
+    """
+
+    def __init__(self, cache_dir, max_bytes=32 * 1024**3, tag=''):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.tag = tag
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        mmcv.mkdir_or_exist(cache_dir)
+        # pick up entries of previous runs, least recently used first
+        names = [
+            name for name in os.listdir(cache_dir)
+            if not name.startswith('.')
+        ]
+        names.sort(key=lambda name: osp.getmtime(osp.join(cache_dir, name)))
+        for name in names:
+            self._register(name)
+
+    def key(self, img_meta, stage=''):
+        """Key of a sample: its index and a hash of the image pipeline.
+
+        ``stage`` names the point of the image branch the features come
+        from, so features of different stages never share an entry.
+        """
+        pipeline = []
+        for k in IMG_PIPELINE_KEYS:
+            value = img_meta.get(k)
+            if isinstance(value, np.ndarray):
+                value = value.tolist()
+            pipeline.append((k, value))
+        pipeline.append(('tag', self.tag))
+        if stage:
+            pipeline.append(('stage', stage))
+        digest = hashlib.md5(repr(pipeline).encode()).hexdigest()[:16]
+        return f"{img_meta['sample_idx']}_{digest}"
+
+    def get(self, img_metas, device, stage=''):
+        """Load the features of a batch of the image branch ``stage``.
+
+        Returns:
+            tuple[torch.Tensor] | None: Features of every level with shape
+                (B, C, H, W), or None if any sample of the batch misses.
+        """
+        samples = []
+        for img_meta in img_metas:
+            key = self.key(img_meta, stage)
+            if not self._register(key):
+                return None
+            try:
+                samples.append(self._load(key))
+            except (OSError, ValueError):
+                # evicted by another process in the meantime
+                self._forget(key)
+                return None
+            self.entries.move_to_end(key)
+        return tuple(
+            torch.from_numpy(np.stack(level)).to(device).float()
+            for level in zip(*samples))
+
+    def put(self, img_metas, mlvl_feats, stage=''):
+        """Store the features of a batch, evicting old entries if needed."""
+        mlvl_feats = [
+            feat.detach().half().cpu().numpy() for feat in mlvl_feats
+        ]
+        for i, img_meta in enumerate(img_metas):
+            key = self.key(img_meta, stage)
+            if key in self.entries:
+                continue
+            path = osp.join(self.cache_dir, key)
+            tmp_path = osp.join(self.cache_dir, f'.{key}.{os.getpid()}')
+            mmcv.mkdir_or_exist(tmp_path)
+            for level, feat in enumerate(mlvl_feats):
+                np.save(osp.join(tmp_path, f'{level}.npy'), feat[i])
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # already written by another process
+                shutil.rmtree(tmp_path, ignore_errors=True)
+            self._register(key)
+        while self.n_bytes > self.max_bytes and len(self.entries) > 1:
+            key = next(iter(self.entries))
+            self._forget(key)
+            shutil.rmtree(osp.join(self.cache_dir, key), ignore_errors=True)
+
+    def _load(self, key):
+        path = osp.join(self.cache_dir, key)
+        n_levels = len(os.listdir(path))
+        feats = [
+            np.load(osp.join(path, f'{level}.npy'), mmap_mode='r')
+            for level in range(n_levels)
+        ]
+        os.utime(path)
+        return feats
+
+    def _register(self, key):
+        if key in self.entries:
+            return True
+        path = osp.join(self.cache_dir, key)
+        if not osp.isdir(path):
+            return False
+        n_bytes = sum(
+            osp.getsize(osp.join(path, name)) for name in os.listdir(path))
+        self.entries[key] = n_bytes
+        self.n_bytes += n_bytes
+        return True
+
+    def _forget(self, key):
+        self.n_bytes -= self.entries.pop(key, 0)
@@ -0,0 +1,63 @@
+import torch
+from torch import nn
+
+try:
+    import MinkowskiEngine as ME
+except ImportError:
+    import warnings
+    warnings.warn(
+        'Please follow `getting_started.md` to install MinkowskiEngine.`')
+
+
+def _minkowski_convs():
+    return (ME.MinkowskiConvolution, ME.MinkowskiConvolutionTranspose,
+            ME.MinkowskiGenerativeConvolutionTranspose)
+
+
+@torch.no_grad()
+def _fuse_minkowski_conv_bn(conv, bn):
+    """Fold the statistics of an eval-mode MinkowskiBatchNorm into the
+    kernel and the bias of the preceding Minkowski convolution."""
+    bn = bn.bn
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        scale = scale * bn.weight
+        shift = shift * bn.weight + bn.bias
+    # output channels are the last dim of Minkowski kernels
+    conv.kernel = nn.Parameter(conv.kernel * scale)
+    bias = shift if conv.bias is None else conv.bias.view(-1) * scale + shift
+    conv.bias = nn.Parameter(bias.view(1, -1))
+    return conv
+
+
+def fuse_minkowski_conv_bn(module):
+    """Recursively fuse Minkowski convolutions and their BatchNorms.
+
+    Like mmcv ``fuse_conv_bn`` for dense convs: a ``MinkowskiBatchNorm``
+    directly following a Minkowski convolution among the children of a
+    module is folded into it and replaced by ``nn.Identity``. This covers
+    the ``nn.Sequential`` blocks of the neck, the downsample paths of
+    ``MinkResNet`` and the conv / norm pairs of the ResNet blocks.
+    Only valid at inference, with the BatchNorm running statistics.
+
+    Args:
+        module (nn.Module): Module to fuse in place.
+
+    Returns:
+        nn.Module: The fused module.
+    """
+    last_conv, last_conv_name = None, None
+    for name, child in module.named_children():
+        if isinstance(child, ME.MinkowskiBatchNorm):
+            if last_conv is None:
+                continue
+            module._modules[last_conv_name] = _fuse_minkowski_conv_bn(
+                last_conv, child)
+            module._modules[name] = nn.Identity()
+            last_conv = None
+        elif isinstance(child, _minkowski_convs()):
+            last_conv, last_conv_name = child, name
+        else:
+            fuse_minkowski_conv_bn(child)
+    return module
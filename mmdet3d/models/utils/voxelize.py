@@ -0,0 +1,87 @@
+import torch
+
+try:
+    import MinkowskiEngine as ME
+except ImportError:
+    import warnings
+    warnings.warn(
+        'Please follow `getting_started.md` to install MinkowskiEngine.`')
+
+
+def batch_voxelize(points, voxel_size, mode='reference'):
+    """Voxelize a batch of colored point clouds into one sparse tensor.
+
+    Args:
+        points (list[torch.Tensor]): Points of each sample with shape
+            (N_i, 6), xyz followed by rgb in [0, 255].
+        voxel_size (float): Voxel size.
+        mode (str, optional): 'packed' quantizes, deduplicates and
+            normalizes the whole batch in one vectorized pass, averaging the
+            colors of points sharing a voxel. 'reference' keeps the
+            per-sample ``ME.utils.batch_sparse_collate`` path, which keeps a
+            random point per voxel, as the detectors were trained with.
+            Default: 'reference'.
+
+    Returns:
+        tuple[ME.SparseTensor, torch.Tensor]: Sparse tensor and, for every
+            input point in concatenated order, the row of the voxel it
+            falls into.
+    """
+    if mode == 'reference':
+        coordinates, features = ME.utils.batch_sparse_collate(
+            [(p[:, :3] / voxel_size, p[:, 3:] / 255.) for p in points],
+            device=points[0].device)
+        x = ME.SparseTensor(coordinates=coordinates, features=features)
+        return x, x.inverse_mapping.long()
+    if mode != 'packed':
+        raise ValueError(f'Unsupported voxelization mode {mode}')
+
+    counts = torch.tensor([len(p) for p in points], device=points[0].device)
+    offsets = torch.cat((counts.new_zeros(1), counts.cumsum(0)))
+    return voxelize_packed(torch.cat(points), offsets, voxel_size)
+
+
+def voxelize_packed(points, offsets, voxel_size):
+    """Voxelize packed points of several samples in one vectorized pass.
+
+    Args:
+        points (torch.Tensor): Points of all samples with shape (N, 6).
+        offsets (torch.Tensor): Start row of every sample followed by N,
+            with shape (B + 1, ).
+        voxel_size (float): Voxel size.
+
+    Returns:
+        tuple[ME.SparseTensor, torch.Tensor]: Sparse tensor and the voxel
+            row of every input point.
+    """
+    counts = offsets[1:] - offsets[:-1]
+    batch_ids = torch.repeat_interleave(
+        torch.arange(len(counts), device=points.device), counts)
+    # batch_sparse_collate floors the float coordinates, truncating towards
+    # zero would merge the voxels on both sides of zero
+    coordinates = torch.cat(
+        (batch_ids[:, None], torch.floor(points[:, :3] / voxel_size).long()),
+        dim=1)
+
+    # linearize (batch, x, y, z) into a single key to deduplicate with one
+    # 1d unique instead of a row-wise unique over the coordinate matrix
+    min_coordinates = coordinates.min(0)[0]
+    shifted = coordinates - min_coordinates
+    extent = shifted.max(0)[0] + 1
+    keys = shifted[:, 0]
+    for i in range(1, 4):
+        keys = keys * extent[i] + shifted[:, i]
+    unique_keys, inverse = torch.unique(keys, return_inverse=True)
+    n_voxels = len(unique_keys)
+
+    voxel_coordinates = coordinates.new_empty((n_voxels, 4))
+    voxel_coordinates[inverse] = coordinates
+    n_points = torch.bincount(inverse, minlength=n_voxels)
+    features = points.new_zeros((n_voxels, points.shape[1] - 3))
+    features.index_add_(0, inverse, points[:, 3:])
+    features /= n_points.unsqueeze(1).to(features.dtype) * 255.
+
+    x = ME.SparseTensor(
+        features=features, coordinates=voxel_coordinates.int())
+    # the sparse tensor may reorder the (already unique) voxels
+    return x, x.inverse_mapping.long()[inverse]
@@ -0,0 +1,119 @@
+import argparse
+import time
+
+import torch
+from mmcv.cnn.bricks.transformer import build_attention
+
+from mmdet3d.models.fusion_layers import deform_attn  # noqa: F401
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark deformable attention variants against '
+        'MultiScaleDeformableAttention, on CPU its pytorch fallback, and '
+        'check that they match')
+    parser.add_argument(
+        '--types',
+        nargs='+',
+        default=['LazyValueDeformableAttention', 'CPUDeformableAttention'],
+        help='attention types to compare with MultiScaleDeformableAttention')
+    parser.add_argument(
+        '--sizes',
+        nargs='+',
+        default=['100x136', '50x68', '25x34', '13x17'],
+        help='image feature sizes HxW, the ChannelMapper levels by default')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument(
+        '--num-query', type=int, default=256, help='stage-2 proposals')
+    parser.add_argument(
+        '--encoder',
+        action='store_true',
+        help='query every value token, as the image encoder does')
+    parser.add_argument('--embed-dims', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--atol', type=float, default=1e-4)
+    parser.add_argument('--rtol', type=float, default=1e-4)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--device', default='cpu')
+    return parser.parse_args()
+
+
+def benchmark(fn, repeat, sync):
+    fn()
+    if sync:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    if sync:
+        torch.cuda.synchronize()
+    return out, (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    sync = device.type == 'cuda'
+    shapes = [tuple(map(int, size.split('x'))) for size in args.sizes]
+    spatial_shapes = torch.tensor(shapes, device=device)
+    level_start_index = torch.cat((spatial_shapes.new_zeros(
+        (1, )), spatial_shapes.prod(1).cumsum(0)[:-1]))
+    num_value = int(spatial_shapes.prod(1).sum())
+    bs, dims = args.batch_size, args.embed_dims
+
+    cfg = dict(
+        embed_dims=dims, num_levels=len(shapes), batch_first=True)
+    reference = build_attention(
+        dict(cfg, type='MultiScaleDeformableAttention')).to(device).eval()
+    # random, not the zero initialized, offsets spread the samples
+    for param in reference.parameters():
+        torch.nn.init.normal_(param, std=.1)
+
+    num_query = num_value if args.encoder else args.num_query
+    value = torch.randn(bs, num_value, dims, device=device)
+    query = value if args.encoder else torch.randn(
+        bs, num_query, dims, device=device)
+    key_padding_mask = torch.zeros(
+        bs, num_value, dtype=torch.bool, device=device)
+    # the right part of the images is padding
+    start = 0
+    for h, w in shapes:
+        key_padding_mask[:, start:start + h * w].view(bs, h, w)[
+            :, :, w * 3 // 4:] = True
+        start += h * w
+    reference_points = torch.rand(
+        bs, num_query, len(shapes), 2, device=device)
+    inputs = dict(
+        query=query,
+        value=value,
+        key_padding_mask=key_padding_mask,
+        reference_points=reference_points,
+        spatial_shapes=spatial_shapes,
+        level_start_index=level_start_index)
+
+    print(f'{num_value} value tokens, {num_query} queries, '
+          f'batch {bs}, {args.device}')
+    print(f'{"type":>32} {"ms":>10} {"speedup":>8} {"max diff":>10} '
+          f'(atol {args.atol:.0e}, rtol {args.rtol:.0e})')
+    matches = []
+    with torch.no_grad():
+        ref, ref_ms = benchmark(lambda: reference(**inputs), args.repeat, sync)
+        print(f'{"MultiScaleDeformableAttention":>32} {ref_ms:>10.2f}')
+        for attn_type in args.types:
+            attn = build_attention(dict(cfg, type=attn_type)).to(device).eval()
+            attn.load_state_dict(reference.state_dict())
+            out, ms = benchmark(lambda: attn(**inputs), args.repeat, sync)
+            diff = (out - ref).abs().max().item()
+            match = torch.allclose(out, ref, atol=args.atol, rtol=args.rtol)
+            matches.append(match)
+            status = 'ok' if match else 'MISMATCH'
+            print(f'{attn_type:>32} {ms:>10.2f} {ref_ms / ms:>7.2f}x '
+                  f'{diff:>10.2e} {status}')
+    if not all(matches):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import argparse
+import time
+
+import torch
+
+from mmdet3d.models.detectors.GLFF3D import SA
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the fused SA modulation of GMFE against the '
+        'per level loop and check that they match')
+    parser.add_argument(
+        '--sizes',
+        nargs='+',
+        default=['100x140', '50x70', '25x35', '13x18'],
+        help='feature map sizes HxW, the four GMFE levels by default')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--device', default='cuda')
+    return parser.parse_args()
+
+
+def benchmark(fn, x, repeat, sync):
+    fn(x)
+    if sync:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = fn(x)
+    if sync:
+        torch.cuda.synchronize()
+    return out, (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device if torch.cuda.is_available() or
+                          args.device == 'cpu' else 'cpu')
+    sync = device.type == 'cuda'
+    sa = SA(args.dim).to(device).eval()
+    print(f'{"size":>10} {"loop ms":>10} {"fused ms":>10} {"speedup":>8} '
+          f'{"max diff":>10}')
+    with torch.no_grad():
+        for size in args.sizes:
+            h, w = map(int, size.split('x'))
+            x = torch.randn(args.batch_size, args.dim, h, w, device=device)
+            ref, loop_ms = benchmark(sa.forward_loop, x, args.repeat, sync)
+            out, fused_ms = benchmark(sa, x, args.repeat, sync)
+            diff = (out - ref).abs().max().item()
+            print(f'{size:>10} {loop_ms:>10.3f} {fused_ms:>10.3f} '
+                  f'{loop_ms / fused_ms:>7.2f}x {diff:>10.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import argparse
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from mmdet.core import reduce_mean
+
+from mmdet3d.models.utils.deferred_norm import DeferredNormalizer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the loss normalization of one iteration with '
+        'per scene reduce_mean calls against one DeferredNormalizer '
+        'all-reduce, on CPU processes with the gloo backend')
+    parser.add_argument(
+        '--world-sizes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument(
+        '--n-heads',
+        type=int,
+        default=3,
+        help='loss computations per iteration, the neck and every '
+        'prediction of the stage-2 head')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--port', type=int, default=29512)
+    return parser.parse_args()
+
+
+def random_losses(batch_size, n_heads):
+    """Per scene loss sums and normalizers of every head."""
+    heads = []
+    for _ in range(n_heads):
+        n_pos = torch.randint(0, 20, (batch_size, )).float()
+        centerness_sum = torch.rand(batch_size) * n_pos
+        heads.append((torch.rand(3, batch_size) * 10, n_pos, centerness_sum))
+    return heads
+
+
+def per_scene(heads):
+    """Two reduce_mean calls per scene and head, as _loss_single did."""
+    losses = dict()
+    for i, (loss_sums, n_pos, centerness_sum) in enumerate(heads):
+        scene_losses = []
+        for j in range(len(n_pos)):
+            n = max(reduce_mean(n_pos[j].clone()), 1.)
+            denorm = max(reduce_mean(centerness_sum[j].clone()), 1e-6)
+            scene_losses.append(
+                torch.stack((loss_sums[0, j] / n, loss_sums[1, j] / n,
+                             loss_sums[2, j] / denorm)))
+        losses[f'loss_{i}'] = torch.stack(scene_losses).mean(dim=0)
+    return losses
+
+
+def deferred(heads):
+    normalizer = DeferredNormalizer()
+    for i, (loss_sums, n_pos, centerness_sum) in enumerate(heads):
+        n = normalizer.register(n_pos, 1.)
+        denorm = normalizer.register(centerness_sum, 1e-6)
+        for k, handle in enumerate((n, n, denorm)):
+            normalizer.add(f'loss_{i}_{k}', loss_sums[k], handle)
+    losses = normalizer.compute()
+    return {
+        f'loss_{i}': torch.stack([losses[f'loss_{i}_{k}'] for k in range(3)])
+        for i in range(len(heads))
+    }
+
+
+def benchmark(fn, heads, repeat):
+    fn(heads)
+    dist.barrier()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = fn(heads)
+    dist.barrier()
+    return out, (time.perf_counter() - start) / repeat * 1000
+
+
+def worker(rank, world_size, port, args):
+    dist.init_process_group(
+        'gloo',
+        init_method=f'tcp://127.0.0.1:{port}',
+        rank=rank,
+        world_size=world_size)
+    torch.manual_seed(rank)
+    heads = random_losses(args.batch_size, args.n_heads)
+    ref, per_scene_ms = benchmark(per_scene, heads, args.repeat)
+    out, deferred_ms = benchmark(deferred, heads, args.repeat)
+    diff = max((out[k] - ref[k]).abs().max().item() for k in ref)
+    if rank == 0:
+        n_calls = 2 * args.batch_size * args.n_heads
+        print(f'{world_size:>6} {n_calls:>8} {per_scene_ms:>14.3f} '
+              f'{deferred_ms:>12.3f} {per_scene_ms / deferred_ms:>7.2f}x '
+              f'{diff:>10.2e}')
+    dist.destroy_process_group()
+
+
+def main():
+    args = parse_args()
+    print(f'{"world":>6} {"calls":>8} {"per scene ms":>14} '
+          f'{"deferred ms":>12} {"speedup":>8} {"max diff":>10}')
+    for i, world_size in enumerate(args.world_sizes):
+        # a fresh port per world size, the previous one may linger
+        mp.spawn(
+            worker,
+            args=(world_size, args.port + i, args),
+            nprocs=world_size)
+
+
+if __name__ == '__main__':
+    main()
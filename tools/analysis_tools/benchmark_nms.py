@@ -0,0 +1,139 @@
+import argparse
+import math
+import time
+
+import torch
+
+from mmdet3d.models.utils.bev_nms import nms_3d, paired_bev_iou, pcdet_nms_gpu
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the 3D NMS backends and check their keep sets')
+    parser.add_argument(
+        '--counts',
+        type=int,
+        nargs='+',
+        default=[1000, 3000, 10000, 30000, 100000],
+        help='numbers of candidate boxes, the detectors feed up to '
+        'nms_pre x n_levels x stages of them')
+    parser.add_argument(
+        '--backends',
+        nargs='+',
+        default=['cpu', 'bucketed', 'gpu'],
+        help='NMS backends to benchmark')
+    parser.add_argument('--iou-thr', type=float, default=.5)
+    parser.add_argument(
+        '--boxes-per-object',
+        type=int,
+        default=40,
+        help='candidates per object, the scene grows with the box count')
+    parser.add_argument(
+        '--dense-max',
+        type=int,
+        default=10000,
+        help='skip the all pairs cpu backend above this count')
+    parser.add_argument(
+        '--no-yaw', action='store_true', help='axis-aligned boxes')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '--check-max',
+        type=int,
+        default=3000,
+        help='also check against a sequential reference up to this count')
+    parser.add_argument(
+        '--bucketed-cuda',
+        action='store_true',
+        help='run the bucketed backend on cuda tensors')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def random_boxes(n_boxes, boxes_per_object, with_yaw):
+    """Detector-like candidates: jittered copies of objects in a scene."""
+    n_objects = max(n_boxes // boxes_per_object, 1)
+    # about 2 m^2 of floor per object, like an indoor room
+    side = (2. * n_objects)**.5
+    centers = torch.rand(n_objects, 3) * torch.tensor([side, side, 2.])
+    sizes = torch.rand(n_objects, 3) * 2.2 + .3
+    yaws = (torch.rand(n_objects, 1) * 2 - 1) * math.pi
+    objects = torch.cat((centers, sizes, yaws), dim=1)
+    boxes = objects[torch.randint(n_objects, (n_boxes, ))]
+    noise = torch.randn(n_boxes, 7)
+    boxes[:, :3] += .1 * noise[:, :3] * boxes[:, 3:6]
+    boxes[:, 3:6] *= torch.exp(.1 * noise[:, 3:6])
+    boxes[:, 6] += .1 * noise[:, 6]
+    if not with_yaw:
+        boxes[:, 6] = 0
+    return boxes, torch.rand(n_boxes)
+
+
+def sequential_nms(boxes, scores, iou_thr, with_yaw):
+    """One box at a time greedy NMS, the reference of the keep sets."""
+    order = scores.sort(descending=True)[1]
+    boxes = boxes[order].double()
+    suppressed = torch.zeros(len(boxes), dtype=torch.bool)
+    keep = []
+    for i in range(len(boxes)):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        ious = paired_bev_iou(boxes[i:i + 1].expand(len(boxes) - i - 1, -1),
+                              boxes[i + 1:], with_yaw)
+        suppressed[i + 1:] |= ious > iou_thr
+    return order[keep]
+
+
+def benchmark(fn, repeat, sync):
+    fn()
+    times = []
+    for _ in range(repeat):
+        if sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        result = fn()
+        if sync:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return result, min(times) * 1000
+
+
+def main():
+    args = parse_args()
+    torch.manual_seed(args.seed)
+    with_yaw = not args.no_yaw
+    cuda = torch.cuda.is_available() and pcdet_nms_gpu is not None
+    backends = [
+        backend for backend in args.backends if backend != 'gpu' or cuda
+    ]
+    print(f'{"boxes":>8} {"backend":>10} {"ms":>10} {"kept":>6}  keep set')
+    for n_boxes in args.counts:
+        boxes, scores = random_boxes(n_boxes, args.boxes_per_object,
+                                     with_yaw)
+        reference, reference_name = None, None
+        if n_boxes <= args.check_max:
+            reference = sequential_nms(boxes, scores, args.iou_thr, with_yaw)
+            reference_name = 'sequential'
+        for backend in backends:
+            if backend == 'cpu' and n_boxes > args.dense_max:
+                continue
+            device = 'cuda' if backend == 'gpu' or (
+                backend == 'bucketed' and args.bucketed_cuda) else 'cpu'
+            inputs = boxes.to(device), scores.to(device)
+            keep, ms = benchmark(
+                lambda: nms_3d(
+                    *inputs, args.iou_thr, with_yaw, backend=backend),
+                args.repeat, device == 'cuda')
+            keep = keep.cpu()
+            if reference is None:
+                reference, reference_name = keep, backend
+                status = 'reference'
+            else:
+                same = set(keep.tolist()) == set(reference.tolist())
+                status = f'{"==" if same else "!="} {reference_name}'
+            print(f'{n_boxes:>8} {backend:>10} {ms:>10.2f} {len(keep):>6}  '
+                  f'{status}')
+
+
+if __name__ == '__main__':
+    main()
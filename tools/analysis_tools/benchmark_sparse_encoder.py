@@ -0,0 +1,80 @@
+import argparse
+import time
+
+import torch
+from mmcv import Config
+from mmcv.parallel import MMDataParallel
+from mmcv.runner import load_checkpoint
+
+from mmdet3d.apis import single_gpu_test
+from mmdet3d.datasets import build_dataloader, build_dataset
+from mmdet3d.models import build_model
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compare the latency and the mAP of the dense image '
+        'encoder against its proposal-guided sparse mode')
+    parser.add_argument('config', help='test config file path')
+    parser.add_argument('checkpoint', help='checkpoint file')
+    parser.add_argument(
+        '--radii',
+        type=int,
+        nargs='+',
+        default=[1, 2, 4],
+        help='retention radii of the sparse mode to evaluate')
+    parser.add_argument('--eval', default='mAP', help='evaluation metric')
+    return parser.parse_args()
+
+
+def run(model, data_loader, dataset, metric):
+    torch.cuda.synchronize()
+    start = time.perf_counter()
+    outputs = single_gpu_test(model, data_loader)
+    torch.cuda.synchronize()
+    ms = (time.perf_counter() - start) / len(dataset) * 1000
+    return ms, dataset.evaluate(outputs, metric=metric)
+
+
+def main():
+    args = parse_args()
+    cfg = Config.fromfile(args.config)
+    cfg.model.train_cfg = None
+    cfg.model.img_encoder.type = 'SparseDeformableDetrEncoder'
+    # cached features are encoded in one mode only
+    cfg.model.pop('img_feat_cache', None)
+    cfg.data.test.test_mode = True
+
+    dataset = build_dataset(cfg.data.test)
+    data_loader = build_dataloader(
+        dataset,
+        samples_per_gpu=1,
+        workers_per_gpu=cfg.data.workers_per_gpu,
+        dist=False,
+        shuffle=False)
+    model = build_model(cfg.model, test_cfg=cfg.get('test_cfg'))
+    checkpoint = load_checkpoint(model, args.checkpoint, map_location='cpu')
+    model.CLASSES = checkpoint.get('meta', {}).get('CLASSES',
+                                                   dataset.CLASSES)
+    encoder = model.img_encoder
+    model = MMDataParallel(model, device_ids=[0])
+
+    results = []
+    encoder.sparse = False
+    results.append(('dense', ) + run(model, data_loader, dataset, args.eval))
+    encoder.sparse = True
+    for radius in args.radii:
+        encoder.radius = [radius] * encoder.num_feature_levels
+        results.append((f'radius {radius}', ) +
+                       run(model, data_loader, dataset, args.eval))
+
+    print(f'{"mode":>10} {"ms/scene":>10} {"speedup":>8} metrics')
+    dense_ms = results[0][1]
+    for mode, ms, metrics in results:
+        maps = ' '.join(f'{k}={v:.4f}' for k, v in metrics.items()
+                        if k.startswith('mAP'))
+        print(f'{mode:>10} {ms:>10.2f} {dense_ms / ms:>7.2f}x {maps}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import argparse
+import copy
+
+import torch
+
+from mmdet3d.models.detectors.GLFF3D import GMFE
+from mmdet3d.models.fusion_layers.transformer import PositionEmbeddingLearned
+from mmdet3d.models.utils.deploy import deploy_model
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Check that the deploy form of the dense modules matches '
+        'their training form')
+    parser.add_argument(
+        '--sizes',
+        nargs='+',
+        default=['100x140', '50x70', '25x35', '13x18'],
+        help='GMFE feature map sizes HxW')
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--n-queries', type=int, default=256)
+    parser.add_argument('--atol', type=float, default=1e-4)
+    parser.add_argument('--device', default='cpu')
+    return parser.parse_args()
+
+
+def randomize(module):
+    """Random affine parameters and BatchNorm statistics."""
+    with torch.no_grad():
+        for name, param in module.named_parameters():
+            if 'norm' in name or name.endswith('.bias'):
+                param.uniform_(-1, 1)
+        for m in module.modules():
+            if isinstance(m, torch.nn.modules.batchnorm._BatchNorm):
+                m.running_mean.uniform_(-1, 1)
+                m.running_var.uniform_(.5, 2)
+                m.weight.uniform_(.5, 2)
+    return module
+
+
+def compare(name, module, inputs, atol):
+    module = randomize(module).eval()
+    deployed = deploy_model(copy.deepcopy(module))
+    with torch.no_grad():
+        expected = module(*inputs)
+        actual = deployed(*inputs)
+    diff = (expected - actual).abs().max().item()
+    status = 'ok' if diff <= atol else 'MISMATCH'
+    print(f'{name:>32} max diff {diff:.2e} {status}')
+    return diff <= atol
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    results = []
+    for size in args.sizes:
+        h, w = map(int, size.split('x'))
+        x = torch.randn(args.batch_size, args.dim, h, w, device=device)
+        results.append(
+            compare(f'GMFE {size}',
+                    GMFE(args.dim).to(device), (x, ), args.atol))
+    xyz = torch.randn(args.batch_size, args.n_queries, 9, device=device)
+    posembed = PositionEmbeddingLearned(
+        dict(input_channel=9, num_pos_feats=args.dim)).to(device)
+    results.append(
+        compare('PositionEmbeddingLearned', posembed, (xyz, ), args.atol))
+    if not all(results):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
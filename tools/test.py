@@ -12,6 +12,8 @@ from mmcv.runner import (get_dist_info, init_dist, load_checkpoint,
 from mmdet3d.apis import single_gpu_test
 from mmdet3d.datasets import build_dataloader, build_dataset
 from mmdet3d.models import build_model
+from mmdet3d.models.utils.deploy import deploy_model
+from mmdet3d.models.utils.fuse_minkowski import fuse_minkowski_conv_bn
 from mmdet.apis import multi_gpu_test, set_random_seed
 from mmdet.datasets import replace_ImageToTensor
 
@@ -27,6 +29,11 @@ def parse_args():
         action='store_true',
         help='Whether to fuse conv and bn, this will slightly increase'
         'the inference speed')
+    parser.add_argument(
+        '--deploy',
+        action='store_true',
+        help='convert the model to its inference-only form (folded norms, '
+        'fused kernels) before testing')
     parser.add_argument(
         '--format-only',
         action='store_true',
@@ -172,6 +179,9 @@ def main():
     checkpoint = load_checkpoint(model, args.checkpoint, map_location='cpu')
     if args.fuse_conv_bn:
         model = fuse_conv_bn(model)
+        model = fuse_minkowski_conv_bn(model)
+    if args.deploy:
+        model = deploy_model(model)
     # old versions did not save class info in checkpoints, this walkaround is
     # for backward compatibility
     if 'CLASSES' in checkpoint.get('meta', {}):